@@ -1,8 +1,118 @@
 import asyncio
+import bisect
+import heapq
+import math
 import re
+import time
+from datetime import datetime, timezone
 from .. import loader, utils
+from telethon.errors import FloodWaitError
 from telethon.tl.types import Message
 
+
+class _TokenBucket:
+    """
+    Токен-бакет для ограничения частоты запросов удаления.
+    FloodWait от Telegram приостанавливает выдачу токенов для всех вызывающих.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        # Пополнение начинается с конца паузы, а не копится за всё её время
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class _LagHistogram:
+    """
+    Гистограмма задержек с фиксированными логарифмическими корзинами:
+    запись — O(1), память не зависит от числа наблюдений.
+    """
+
+    # Границы корзин от 0.1с до ~8.5 суток с шагом ×1.5; всё дольше попадает в открытую корзину
+    BOUNDS = [0.1 * 1.5 ** i for i in range(40)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.total += 1
+
+    def percentile(self, q: float) -> float | None:
+        """
+        Верхняя граница корзины, в которую попадает квантиль q;
+        math.inf, если это открытая корзина сверх BOUNDS[-1].
+        """
+        if not self.total:
+            return None
+
+        rank = q * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else math.inf
+        return math.inf
+
+
+class _MinuteRate:
+    """
+    Кольцевой счётчик событий по минутам за последний час.
+    """
+
+    SLOTS = 60
+
+    def __init__(self):
+        self.counts = [0] * self.SLOTS
+        self.minutes = [0] * self.SLOTS
+
+    def add(self, count: int = 1):
+        minute = int(time.time() // 60)
+        slot = minute % self.SLOTS
+        if self.minutes[slot] != minute:
+            self.minutes[slot] = minute
+            self.counts[slot] = 0
+        self.counts[slot] += count
+
+    def per_minute(self, window: int) -> float:
+        """
+        Среднее число событий в минуту за последние `window` полных минут.
+        """
+        current = int(time.time() // 60)
+        total = sum(
+            count
+            for minute, count in zip(self.minutes, self.counts)
+            if current - window <= minute < current
+        )
+        return total / window
+
+
 class AutoDelChat(loader.Module):
     """
     ✨ AutoDelChat: Эфемерные сообщения для вашей приватности и порядка! ✨
@@ -22,7 +132,7 @@ class AutoDelChat(loader.Module):
     
     strings = {"name": "AutoDelChat"}
     
-    __version__ = "1.7" # Обновляем версию, так как внесены правки и улучшения
+    __version__ = "1.8" # Обновляем версию, так как внесены правки и улучшения
 
     CONFIG_SCHEMA = {
         "enabled": loader.ConfigValue(
@@ -33,39 +143,450 @@ class AutoDelChat(loader.Module):
             0,
             lambda: "Задержка перед удалением сообщения в секундах (0 = немедленно). Поддерживает 's', 'm', 'h', 'd' при установке.",
         ),
+        "rules": loader.ConfigValue(
+            {},
+            lambda: "Правила задержки: ключ — id чата или тип (private, group, channel), значение — секунды или 'off'.",
+        ),
+        "allow_only": loader.ConfigValue(
+            False,
+            lambda: "Удалять сообщения только в чатах, для которых задано отдельное правило.",
+        ),
+        "batch_window": loader.ConfigValue(
+            1,
+            lambda: "Окно объединения удалений в секундах: созревшие за это время сообщения удаляются одним запросом на чат.",
+        ),
     }
 
+    # Максимум id в одном вызове delete_messages (ограничение Telegram)
+    _DELETE_CHUNK = 100
+    # Как часто (в секундах) сохранять очередь в базу
+    _PERSIST_INTERVAL = 5
+    # Устойчивая частота запросов удаления (в секунду) и допустимый всплеск
+    _DELETE_RATE = 2
+    _DELETE_BURST = 5
+    # Сколько раз повторять неудачное удаление и базовая пауза между попытками
+    _MAX_RETRIES = 5
+    _RETRY_BASE_DELAY = 10
+    # Типы чатов, для которых можно задать отдельную задержку
+    _PEER_TYPES = ("private", "group", "channel")
+    # Как часто (в секундах) обновлять сообщение с прогрессом очистки истории
+    _SWEEP_PROGRESS_INTERVAL = 5
+
     async def on_load(self):
+        self._init_state()
+        self._rebuild_rules()
+        # Восстанавливаем очередь, сохранённую до перезапуска/перезагрузки модуля.
+        # Просроченное за время выгрузки воркер удалит первым же проходом, не задерживая загрузку.
+        self._restore_pending()
+        self._ensure_worker()
         self.log.info(f"Модуль {self.strings['name']} v{self.__version__} загружен!")
 
-    # Вспомогательный метод для планирования удаления
-    async def _delete_message_after_delay(self, message: Message, delay: int):
+    async def on_unload(self):
+        if getattr(self, "_worker_task", None):
+            self._worker_task.cancel()
+        if getattr(self, "_sweep_task", None):
+            self._sweep_task.cancel()
+        # Отложенная запись старого экземпляра не должна перезаписать очередь нового после перезагрузки
+        if getattr(self, "_persist_task", None):
+            self._persist_task.cancel()
+        if getattr(self, "_queue", None) is not None:
+            self._flush_pending()
+
+    # --- Планировщик удалений ---
+
+    def _init_state(self):
+        # Очередь удалений: мин-куча компактных кортежей (due_ts, chat_id, msg_id, attempts, first_due_ts),
+        # где first_due_ts — изначальный срок удаления, не сдвигаемый повторами и FloodWait.
+        # Вместо отдельной спящей задачи с полным объектом Message на каждое
+        # сообщение держим одну кучу и один воркер.
+        self._queue = []
+        # Записи, извлечённые из кучи, но ещё не удалённые: {(chat_id, msg_id): запись}.
+        # Сохраняются вместе с кучей, чтобы перезапуск во время удаления их не потерял.
+        self._inflight = {}
+        self._wakeup = asyncio.Event()
+        self._worker_task = None
+        # Очередь сохраняется в базу отложенно: серия изменений даёт одну запись
+        self._persist_task = None
+        # Все удаления модуля проходят через общий ограничитель частоты
+        self._governor = _TokenBucket(self._DELETE_RATE, self._DELETE_BURST)
+        self._sweep_task = None
+        # Метрики: задержка фактического удаления относительно first_due_ts,
+        # темп удалений и ошибки по типам исключений.
+        self._lag_hist = _LagHistogram()
+        self._deletion_rate = _MinuteRate()
+        self._failures = {}
+        self._deleted_total = 0
+        self._dropped_total = 0
+
+    def _ensure_worker(self):
         """
-        Запланировать удаление сообщения после заданной задержки.
+        Запускает единственный воркер планировщика, если он ещё не запущен.
         """
-        if delay > 0:
-            await asyncio.sleep(delay)
-        
+        if not hasattr(self, "_queue"):
+            self._init_state()
+            self._rebuild_rules()
+
+        if self._worker_task is None or self._worker_task.done():
+            self._worker_task = asyncio.ensure_future(self._scheduler_loop())
+
+    def _schedule_deletion(self, chat_id: int, msg_id: int, delay: float, attempts: int = 0, first_due_ts: float = None):
+        """
+        Добавляет сообщение в очередь на удаление через `delay` секунд.
+        `first_due_ts` передаётся при повторе, чтобы опоздание считалось от исходного срока.
+        """
+        due_ts = time.time() + max(delay, 0)
+        entry = (due_ts, chat_id, msg_id, attempts, due_ts if first_due_ts is None else first_due_ts)
+        heapq.heappush(self._queue, entry)
+        self._persist_soon()
+
+        # Будим воркер только если новое сообщение должно удалиться раньше всех остальных
+        if self._queue[0] is entry:
+            self._wakeup.set()
+
+    # --- Сохранение очереди в базе ---
+
+    def _restore_pending(self):
+        """
+        Загружает сохранённую очередь из базы в кучу.
+        """
+        stored = self.get("pending") or []
+        # Записи старых форматов хранятся без счётчика попыток и/или исходного срока
+        self._queue = []
+        for entry in stored:
+            due_ts, chat_id, msg_id = entry[:3]
+            attempts = entry[3] if len(entry) > 3 else 0
+            first_due_ts = entry[4] if len(entry) > 4 else due_ts
+            self._queue.append((due_ts, chat_id, msg_id, attempts, first_due_ts))
+        heapq.heapify(self._queue)
+
+    def _persist_soon(self):
+        """
+        Откладывает запись очереди в базу, чтобы серия изменений дала одну запись.
+        """
+        if self._persist_task is None or self._persist_task.done():
+            self._persist_task = asyncio.ensure_future(self._persist_later())
+
+    async def _persist_later(self):
+        await asyncio.sleep(self._PERSIST_INTERVAL)
+        self._flush_pending()
+
+    def _flush_pending(self):
+        """
+        Записывает в базу снимок кучи и удаляемых в данный момент записей.
+        Копируется только список ссылок: кортежи записей общие с кучей.
+        """
+        self.set("pending", self._queue + list(self._inflight.values()))
+
+    async def _drain_overdue(self):
+        """
+        Удаляет все созревшие сообщения: группирует их по чатам и вызывает
+        delete_messages не более чем по 100 id за раз.
+        """
+        now = time.time()
+        by_chat = {}
+        while self._queue and self._queue[0][0] <= now:
+            entry = heapq.heappop(self._queue)
+            _, chat_id, msg_id, attempts, first_due_ts = entry
+            self._inflight[(chat_id, msg_id)] = entry
+            by_chat.setdefault(chat_id, []).append((msg_id, attempts, first_due_ts))
+
+        if not by_chat:
+            return
+
+        for chat_id, items in by_chat.items():
+            for i in range(0, len(items), self._DELETE_CHUNK):
+                await self._delete_messages(chat_id, items[i:i + self._DELETE_CHUNK])
+
+    async def _scheduler_loop(self):
+        """
+        Единственный воркер: спит до ближайшего due_ts и удаляет созревшие сообщения.
+        """
+        while True:
+            self._wakeup.clear()
+
+            if not self._queue:
+                await self._wakeup.wait()
+                continue
+
+            timeout = self._queue[0][0] - time.time()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Ждём короткое окно, чтобы соседние по времени удаления
+            # попали в ту же пачку, и удаляем всё созревшее одним проходом.
+            window = self.get("batch_window", 1)
+            if window:
+                await asyncio.sleep(window)
+            await self._drain_overdue()
+
+    async def _delete_messages(self, chat_id: int, items: list):
+        """
+        Удаляет сообщения одного чата. `items` — список (msg_id, attempts, first_due_ts).
+        Неудачные удаления возвращаются в очередь с ограниченным числом повторов.
+        """
+        msg_ids = [msg_id for msg_id, _, _ in items]
+        await self._governor.acquire()
         try:
-            # Для исходящих сообщений message.delete() обычно удаляет для всех.
-            # Если требуется явное удаление для всех, можно использовать revoke=True,
-            # но для своих сообщений это часто избыточно.
-            await message.delete() 
-            self.log.debug(f"Сообщение {message.id} в чате {message.chat_id} удалено после задержки {delay}с.")
+            # Для исходящих сообщений delete_messages по умолчанию удаляет для всех (revoke=True).
+            await self.client.delete_messages(chat_id, msg_ids)
+            self.log.debug(f"Сообщения {msg_ids} в чате {chat_id} удалены.")
+            now = time.time()
+            for _, _, first_due_ts in items:
+                self._lag_hist.add(now - first_due_ts)
+            self._deletion_rate.add(len(items))
+            self._deleted_total += len(items)
+        except FloodWaitError as e:
+            self._record_failure(e, len(items))
+            # Останавливаем все удаления на время FloodWait и откладываем пачку,
+            # не засчитывая это как неудачную попытку.
+            self._governor.pause(e.seconds)
+            self.log.debug(f"FloodWait {e.seconds}с при удалении в чате {chat_id}, пачка отложена.")
+            for msg_id, attempts, first_due_ts in items:
+                self._schedule_deletion(chat_id, msg_id, e.seconds, attempts, first_due_ts)
         except Exception as e:
-            # В случае ошибки удаления (например, сообщение слишком старое, уже удалено,
-            # или нет прав), просто логируем и игнорируем, чтобы не прерывать работу
-            self.log.debug(f"Не удалось удалить сообщение {message.id} в чате {message.chat_id}: {e}")
+            self._record_failure(e, len(items))
+            # Ошибка удаления (сообщение уже удалено, нет прав, сетевой сбой) —
+            # повторяем с экспоненциальной паузой, пока не исчерпаны попытки.
+            for msg_id, attempts, first_due_ts in items:
+                if attempts + 1 >= self._MAX_RETRIES:
+                    self.log.debug(f"Не удалось удалить сообщение {msg_id} в чате {chat_id} после {attempts + 1} попыток: {e}")
+                    self._dropped_total += 1
+                    continue
+                self._schedule_deletion(chat_id, msg_id, self._RETRY_BASE_DELAY * 2 ** attempts, attempts + 1, first_due_ts)
+
+        # Пачка удалена, отброшена или вернулась в кучу — из сохраняемых «в работе» её убираем.
+        # При отмене (выгрузка модуля) сюда не доходим, и записи остаются в снимке.
+        for msg_id, _, _ in items:
+            self._inflight.pop((chat_id, msg_id), None)
+        self._persist_soon()
+    def _record_failure(self, error: Exception, count: int):
+        name = type(error).__name__
+        self._failures[name] = self._failures.get(name, 0) + count
+
+    # --- Правила задержки ---
+
+    def _rebuild_rules(self):
+        """
+        Компилирует настройки из базы в индекс в памяти, чтобы watcher
+        обходился поиском в словаре без обращений к базе.
+        Вызывается при загрузке и после каждого изменения настроек.
+        """
+        chat_rules = {}
+        type_rules = {}
+        for key, value in (self.get("rules") or {}).items():
+            delay = None if value == "off" else int(value)
+            if key in self._PEER_TYPES:
+                type_rules[key] = delay
+            else:
+                chat_rules[int(key)] = delay
+
+        self._rules_enabled = bool(self.get("enabled"))
+        self._default_delay = self.get("delay_seconds") or 0
+        self._allow_only = bool(self.get("allow_only"))
+        self._chat_rules = chat_rules
+        self._type_rules = type_rules
+
+    def _set_setting(self, key: str, value):
+        self.set(key, value)
+        self._rebuild_rules()
+
+    def _set_rule(self, target: str, value):
+        rules = dict(self.get("rules") or {})
+        if value is None:
+            rules.pop(target, None)
+        else:
+            rules[target] = value
+        self._set_setting("rules", rules)
+
+    def _resolve_delay(self, chat_id: int, peer_type: str) -> int | None:
+        """
+        Возвращает задержку для чата или None, если удалять в нём не нужно.
+        """
+        delay = self._chat_rules.get(chat_id, ...)
+        if delay is not ...:
+            return delay
+
+        if self._allow_only:
+            return None
+
+        return self._type_rules.get(peer_type, self._default_delay)
+
+    @staticmethod
+    def _peer_type(obj) -> str:
+        """
+        Тип чата для сообщения или диалога: private, group или channel.
+        """
+        if obj.is_private if isinstance(obj, Message) else obj.is_user:
+            return "private"
+        if obj.is_group:
+            return "group"
+        return "channel"
 
     @loader.watcher(outgoing=True)
     async def watcher(self, message: Message):
+        self._ensure_worker()
+
         # Проверяем, включен ли модуль
-        if self.get("enabled"):
-            delay = self.get("delay_seconds")
-            
-            # Планируем удаление сообщения в фоновом режиме, не блокируя watcher.
-            # Это позволяет watcher'у сразу обрабатывать следующие исходящие сообщения.
-            asyncio.create_task(self._delete_message_after_delay(message, delay))
+        if not self._rules_enabled:
+            return
+
+        delay = self._resolve_delay(message.chat_id, self._peer_type(message))
+        if delay is None:
+            return
+
+        # Кладём в очередь только идентификаторы, а не сам объект Message.
+        # Watcher не блокируется и сразу обрабатывает следующие исходящие сообщения.
+        self._schedule_deletion(message.chat_id, message.id, delay)
+
+    # --- Очистка уже существующей истории ---
+
+    async def _sweep(self, status: Message, targets: list | None):
+        """
+        Удаляет собственные сообщения старше настроенной задержки.
+        `targets` — список пар (chat_id, peer_type) или None для всех диалогов.
+        """
+        deleted = 0
+        chats_done = 0
+        last_report = time.monotonic()
+
+        async def report(final: bool = False):
+            nonlocal last_report
+            now = time.monotonic()
+            if not final and now - last_report < self._SWEEP_PROGRESS_INTERVAL:
+                return
+            last_report = now
+            state = "завершена" if final else "идёт"
+            try:
+                await utils.answer(
+                    status,
+                    f"<b>🧹 Очистка истории {state}.</b>\n"
+                    f"  Обработано чатов: <code>{chats_done}</code>\n"
+                    f"  Удалено сообщений: <code>{deleted}</code>"
+                    + ("" if final else "\n\n<i>Остановить: <code>.autodelete sweep stop</code></i>"),
+                )
+            except Exception as e:
+                self.log.debug(f"Не удалось обновить прогресс очистки: {e}")
+
+        async def iter_targets():
+            if targets is not None:
+                for chat_id, peer_type in targets:
+                    yield chat_id, chat_id, peer_type
+                return
+            async for dialog in self.client.iter_dialogs():
+                yield dialog.id, dialog.entity, self._peer_type(dialog)
+
+        async for chat_id, entity, peer_type in iter_targets():
+            delay = self._resolve_delay(chat_id, peer_type)
+            if delay is None:
+                chats_done += 1
+                continue
+
+            cutoff = datetime.fromtimestamp(time.time() - delay, tz=timezone.utc)
+            batch = []
+            try:
+                async for msg in self.client.iter_messages(entity, from_user="me", offset_date=cutoff):
+                    batch.append(msg.id)
+                    if len(batch) >= self._DELETE_CHUNK:
+                        deleted += await self._sweep_delete(entity, batch)
+                        batch = []
+                        await report()
+                if batch:
+                    deleted += await self._sweep_delete(entity, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log.debug(f"Не удалось очистить историю чата {chat_id}: {e}")
+
+            chats_done += 1
+            await report()
+
+        await report(final=True)
+
+    async def _sweep_delete(self, entity, msg_ids: list) -> int:
+        """
+        Удаляет пачку id под общим ограничителем, повторяя её после FloodWait.
+        """
+        while True:
+            await self._governor.acquire()
+            try:
+                await self.client.delete_messages(entity, msg_ids)
+                return len(msg_ids)
+            except FloodWaitError as e:
+                self._governor.pause(e.seconds)
+
+    async def _sweep_command(self, message: Message, args: list):
+        """
+        .autodelete sweep [all confirm|stop]
+        """
+        mode = args[0].lower() if args else "here"
+
+        if mode == "stop":
+            if self._sweep_task and not self._sweep_task.done():
+                self._sweep_task.cancel()
+                await utils.answer(message, "Очистка истории <b>остановлена</b>. <emoji document_id=5823396554345549784>✔️</emoji>")
+            else:
+                await utils.answer(message, "Очистка истории не запущена. <emoji document_id=5778527486270770928>❌</emoji>")
+            return
+
+        if self._sweep_task and not self._sweep_task.done():
+            await utils.answer(message, "Очистка истории уже идёт. Остановить: <code>.autodelete sweep stop</code> <emoji document_id=5778527486270770928>❌</emoji>")
+            return
+
+        if mode not in ("here", "all"):
+            await utils.answer(message, "Используйте <code>.autodelete sweep</code>, <code>.autodelete sweep all confirm</code> или <code>.autodelete sweep stop</code>. <emoji document_id=5778527486270770928>❌</emoji>")
+            return
+
+        # Очистка следует тем же правилам, что и автоудаление, поэтому при выключенном модуле не запускается
+        if not self._rules_enabled:
+            await utils.answer(message, "Автоудаление <b>выключено</b>, очистка истории не запущена. Включите его: <code>.autodelete on</code> <emoji document_id=5778527486270770928>❌</emoji>")
+            return
+
+        if mode == "all" and (len(args) < 2 or args[1].lower() != "confirm"):
+            delay = self._default_delay
+            scope = f"старше <code>{self._format_seconds_to_human_readable(delay)}</code>" if delay else "<b>все</b>"
+            await utils.answer(
+                message,
+                f"<b>⚠️ Очистка всех диалогов</b> удалит {scope} ваши сообщения во всех чатах "
+                "(с учётом правил по чатам и типам) без возможности восстановления.\n"
+                "Для запуска отправьте <code>.autodelete sweep all confirm</code>",
+            )
+            return
+
+        status = await utils.answer(message, "<b>🧹 Начинаю очистку истории...</b>")
+        targets = None if mode == "all" else [(message.chat_id, self._peer_type(message))]
+        self._sweep_task = asyncio.ensure_future(self._sweep(status, targets))
+
+    # --- Статистика ---
+
+    def _format_stats(self) -> str:
+        def fmt_lag(q: float) -> str:
+            value = self._lag_hist.percentile(q)
+            if value is None:
+                return "—"
+            if value == math.inf:
+                return f">{self._format_seconds_to_human_readable(int(self._lag_hist.BOUNDS[-1]))}"
+            if value < 60:
+                return f"≤{value:.1f}с"
+            return f"≤{self._format_seconds_to_human_readable(math.ceil(value))}"
+
+        failures = sum(self._failures.values())
+        attempts = self._deleted_total + failures
+        failure_rate = f"{failures / attempts:.1%}" if attempts else "—"
+        lines = [
+            "<b>📈 Статистика AutoDelChat:</b>",
+            f"  В очереди: <code>{len(self._queue)}</code>",
+            f"  Удалено с момента загрузки: <code>{self._deleted_total}</code>",
+            f"  Удалений в минуту: <code>{self._deletion_rate.per_minute(1):.0f}</code> (за час в среднем <code>{self._deletion_rate.per_minute(60):.1f}</code>)",
+            f"  Опоздание p50/p95/p99: <code>{fmt_lag(0.5)}</code> / <code>{fmt_lag(0.95)}</code> / <code>{fmt_lag(0.99)}</code>",
+            f"  Ошибки: <code>{failures}</code> ({failure_rate}), отброшено после повторов: <code>{self._dropped_total}</code>",
+        ]
+        for name, count in sorted(self._failures.items(), key=lambda item: -item[1]):
+            lines.append(f"    <code>{name}</code>: <code>{count}</code>")
+        return "\n".join(lines)
 
     # --- Вспомогательные методы для парсинга и форматирования времени ---
 
@@ -139,10 +660,57 @@ class AutoDelChat(loader.Module):
         
         return " ".join(parts)
 
+    def _format_rules(self) -> str:
+        rules = self.get("rules") or {}
+        if not rules:
+            return "  Правила: <i>нет</i>\n"
+
+        lines = ["  Правила:"]
+        for target, value in rules.items():
+            value_text = "не удалять" if value == "off" else self._format_seconds_to_human_readable(int(value))
+            lines.append(f"    <code>{target}</code>: <code>{value_text}</code>")
+        return "\n".join(lines) + "\n"
+
+    async def _rule_command(self, message: Message, args: list):
+        """
+        .autodelete rule <here|private|group|channel|id> <время|off|reset>
+        """
+        if len(args) < 2:
+            await utils.answer(message, "Укажите цель и значение. Например: <code>.autodelete rule private 1h</code> или <code>.autodelete rule here off</code> <emoji document_id=5778527486270770928>❌</emoji>")
+            return
+
+        target, value_str = args[0].lower(), args[1].lower()
+        if target == "here":
+            target = str(message.chat_id)
+        elif target not in self._PEER_TYPES and not re.match(r"^-?\d+$", target):
+            await utils.answer(message, f"Неизвестная цель '<code>{target}</code>'. Используйте here, private, group, channel или id чата. <emoji document_id=5778527486270770928>❌</emoji>")
+            return
+
+        if value_str == "reset":
+            self._set_rule(target, None)
+            await utils.answer(message, f"Правило для <code>{target}</code> удалено. <emoji document_id=5823396554345549784>✔️</emoji>")
+            return
+
+        if value_str == "off":
+            self._set_rule(target, "off")
+            await utils.answer(message, f"Сообщения в <code>{target}</code> удаляться не будут. <emoji document_id=5823396554345549784>✔️</emoji>")
+            return
+
+        parsed_delay = self._parse_delay_string(value_str)
+        if parsed_delay is None:
+            await utils.answer(message, f"Неверное значение задержки '<code>{value_str}</code>'. Например: <code>10s</code>, <code>5m</code>, <code>off</code>. <emoji document_id=5778527486270770928>❌</emoji>")
+            return
+
+        self._set_rule(target, parsed_delay)
+        formatted_delay = self._format_seconds_to_human_readable(parsed_delay)
+        await utils.answer(message, f"Задержка для <code>{target}</code> установлена на <code>{formatted_delay}</code>. <emoji document_id=5823396554345549784>✔️</emoji>")
+
     # --- Команда autodelete ---
 
     @loader.command(
-        ru_doc=".autodelete [on|off|<время>] - Включить/выключить автоудаление или установить задержку. "
+        ru_doc=".autodelete [on|off|<время>|window <время>|rule <цель> <время|off|reset>|only on|off|sweep [all confirm|stop]|stats] - Включить/выключить автоудаление, "
+              "установить задержку, окно объединения или правила для отдельных чатов и типов чатов. "
+              "sweep [all confirm|stop] удаляет уже отправленные сообщения старше задержки, stats показывает метрики очереди. "
               "Примеры времени: 10s (секунды), 5m (минуты), 2h (часы), 1d (дни)."
     )
     async def autodelete(self, message: Message):
@@ -151,18 +719,28 @@ class AutoDelChat(loader.Module):
         if not args:
             # Вывод текущего статуса модуля
             status_text = "<b>Включено</b> <emoji document_id=5823396554345549784>✔️</emoji>" if self.get("enabled") else "<b>Выключено</b> <emoji document_id=5778527486270770928>❌</emoji>"
-            delay_seconds = self.get("delay_seconds")
+            delay_seconds = self.get("delay_seconds") or 0
             delay_text = self._format_seconds_to_human_readable(delay_seconds)
+            window_text = self._format_seconds_to_human_readable(self.get("batch_window", 1))
+            rules_text = self._format_rules()
 
             await utils.answer(
                 message,
                 f"<b>⚙️ Статус AutoDelChat:</b>\n"
                 f"  Автоудаление: {status_text}\n"
-                f"  Задержка: <code>{delay_text}</code>\n\n"
+                f"  Задержка: <code>{delay_text}</code>\n"
+                f"  Окно объединения: <code>{window_text}</code>\n"
+                f"  Только чаты с правилами: <code>{'да' if self.get('allow_only') else 'нет'}</code>\n"
+                f"{rules_text}\n"
                 f"<b>Использование:</b>\n"
                 f"  <code>.autodelete on</code> — Включить\n"
                 f"  <code>.autodelete off</code> — Выключить\n"
                 f"  <code>.autodelete &lt;время&gt;</code> — Установить задержку\n"
+                f"  <code>.autodelete window &lt;время&gt;</code> — Окно объединения удалений\n"
+                f"  <code>.autodelete rule &lt;here|private|group|channel|id&gt; &lt;время|off|reset&gt;</code> — Правило для чата или типа чатов\n"
+                f"  <code>.autodelete only on|off</code> — Удалять только в чатах с правилами\n"
+                f"  <code>.autodelete sweep [all confirm|stop]</code> — Удалить свои старые сообщения в этом чате или во всех\n"
+                f"  <code>.autodelete stats</code> — Очередь, опоздание удалений и ошибки\n"
                 f"  <i>Примеры времени: <code>10s</code>, <code>5m</code>, <code>2h</code>, <code>1d</code> (<code>0s</code> для мгновенного удаления)</i>\n\n"
                 f"<b>Разработчик:</b> @Androfon_AI"
             )
@@ -171,11 +749,40 @@ class AutoDelChat(loader.Module):
         first_arg = args[0].lower()
 
         if first_arg == "on":
-            self.set("enabled", True)
+            self._set_setting("enabled", True)
             await utils.answer(message, "Автоматическое удаление сообщений <b>включено</b>. <emoji document_id=5823396554345549784>✔️</emoji>")
         elif first_arg == "off":
-            self.set("enabled", False)
+            self._set_setting("enabled", False)
             await utils.answer(message, "Автоматическое удаление сообщений <b>выключено</b>. <emoji document_id=5778527486270770928>❌</emoji>")
+        elif first_arg == "window":
+            if len(args) < 2:
+                await utils.answer(message, "Укажите окно объединения. Например: <code>.autodelete window 2s</code> <emoji document_id=5778527486270770928>❌</emoji>")
+                return
+            parsed_window = self._parse_delay_string(args[1])
+
+            if parsed_window is not None:
+                self.set("batch_window", parsed_window)
+                formatted_window = self._format_seconds_to_human_readable(parsed_window)
+                await utils.answer(message, f"Окно объединения удалений установлено на <code>{formatted_window}</code>. <emoji document_id=5823396554345549784>✔️</emoji>")
+            else:
+                await utils.answer(message, f"Неверное значение окна '<code>{args[1]}</code>'. Например: <code>1s</code>, <code>5s</code>. <emoji document_id=5778527486270770928>❌</emoji>")
+        elif first_arg == "rule":
+            await self._rule_command(message, args[1:])
+        elif first_arg == "sweep":
+            await self._sweep_command(message, args[1:])
+        elif first_arg == "stats":
+            self._ensure_worker()
+            await utils.answer(message, self._format_stats())
+        elif first_arg == "only":
+            if len(args) < 2 or args[1].lower() not in ("on", "off"):
+                await utils.answer(message, "Укажите режим. Например: <code>.autodelete only on</code> <emoji document_id=5778527486270770928>❌</emoji>")
+                return
+            allow_only = args[1].lower() == "on"
+            self._set_setting("allow_only", allow_only)
+            if allow_only:
+                await utils.answer(message, "Теперь сообщения удаляются <b>только</b> в чатах с отдельным правилом. <emoji document_id=5823396554345549784>✔️</emoji>")
+            else:
+                await utils.answer(message, "Сообщения удаляются во всех чатах, кроме запрещённых правилами. <emoji document_id=5823396554345549784>✔️</emoji>")
         # УЛУЧШЕНИЕ: Можно убрать явный 'delay' аргумент, так как `<время>` уже обрабатывается.
         # Но если вы хотите сохранить его для большей ясности синтаксиса, это тоже допустимо.
         # Я оставлю его, но отмечу, что он может быть избыточным.
@@ -187,7 +794,7 @@ class AutoDelChat(loader.Module):
             parsed_delay = self._parse_delay_string(delay_str)
             
             if parsed_delay is not None:
-                self.set("delay_seconds", parsed_delay)
+                self._set_setting("delay_seconds", parsed_delay)
                 formatted_delay = self._format_seconds_to_human_readable(parsed_delay)
                 await utils.answer(message, f"Задержка перед удалением установлена на <code>{formatted_delay}</code>. <emoji document_id=5823396554345549784>✔️</emoji>")
             else:
@@ -196,7 +803,7 @@ class AutoDelChat(loader.Module):
             parsed_delay = self._parse_delay_string(first_arg)
             
             if parsed_delay is not None:
-                self.set("delay_seconds", parsed_delay)
+                self._set_setting("delay_seconds", parsed_delay)
                 formatted_delay = self._format_seconds_to_human_readable(parsed_delay)
                 await utils.answer(message, f"Задержка перед удалением установлена на <code>{formatted_delay}</code>. <emoji document_id=5823396554345549784>✔️</emoji>")
             else:
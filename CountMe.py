@@ -14,12 +14,187 @@ from .. import loader, utils
 from telethon.tl.types import Message, Channel, Chat, User
 from telethon.errors import FloodWaitError
 import asyncio
+import heapq
+import time
+from datetime import datetime, timedelta, timezone
+
+
+class _FloodGate:
+    """Общая пауза для всех воркеров: при FloodWait останавливаются все, а не один диалог."""
+
+    def __init__(self):
+        self._open = asyncio.Event()
+        self._open.set()
+        self._until = 0.0
+
+    async def wait(self):
+        await self._open.wait()
+
+    async def pause(self, seconds: float):
+        """Закрывает шлюз на `seconds` секунд (продлевает, если пауза уже идёт) и ждёт открытия."""
+        until = time.monotonic() + seconds
+        if until <= self._until:
+            await self.wait()
+            return
+
+        self._until = until
+        if not self._open.is_set():
+            await self.wait()
+            return
+
+        self._open.clear()
+        while (remaining := self._until - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+        self._open.set()
+
+
+class _ProgressReporter:
+    """
+    Редактирует сообщение о прогрессе не чаще одного раза в `interval` секунд
+    и показывает скорость (сообщений/с) и ETA по оставшемуся диапазону id.
+    """
+
+    def __init__(self, client, status: Message, interval: float):
+        self.client = client
+        self.status = status
+        self.interval = interval
+        self.messages = 0
+        self.ids_total = 0
+        self.ids_done = 0
+        self._started = time.monotonic()
+        self._last_edit = self._started
+
+    def add_span(self, ids: int):
+        """Добавляет к объёму работы диапазон id, который ещё предстоит пройти."""
+        self.ids_total += max(ids, 0)
+
+    def advance(self, messages: int = 0, ids: int = 0):
+        self.messages += messages
+        self.ids_done += max(ids, 0)
+
+    def _format(self, title: str) -> str:
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        rate = self.messages / elapsed
+        text = f"<b>[CountMe]</b> {title}\nСкорость: <code>{rate:.0f}</code> сообщ./с"
+
+        remaining = self.ids_total - self.ids_done
+        if self.ids_done and remaining > 0:
+            eta = int(remaining / (self.ids_done / elapsed))
+            text += f", осталось примерно <code>{eta // 60}м {eta % 60}с</code>"
+        return text + " <emoji document_id=5900104897885376843>🕓</emoji>"
+
+    async def report(self, title: str):
+        """Редактирует сообщение, если с прошлого редактирования прошло не меньше `interval` секунд."""
+        now = time.monotonic()
+        if now - self._last_edit < self.interval:
+            return
+
+        self._last_edit = now
+        try:
+            await self.client.edit_message(self.status.chat_id, self.status.id, self._format(title))
+        except FloodWaitError as e:
+            # Прогресс не должен съедать лимит запросов: при FloodWait реже редактируем
+            self.interval = max(self.interval * 2, e.seconds)
+        except Exception:
+            pass
+
+
+class _Breakdown:
+    """
+    Сводка по вашим сообщениям за один потоковый проход: топ-N диалогов (ограниченная куча),
+    гистограмма по месяцам (массив фиксированной длины) и разбивка по типу чата.
+    Память не зависит от числа диалогов и сообщений.
+    """
+
+    # Telegram запущен в 2013 году — раньше сообщений быть не может
+    FIRST_YEAR = 2013
+    CHAT_TYPES = ("user", "group", "channel")
+
+    def __init__(self, top_n: int):
+        self.top_n = top_n
+        self.top = []  # мин-куча (count, dialog_id, title)
+        self.years = datetime.now(timezone.utc).year - self.FIRST_YEAR + 1
+        self.months = [0] * (self.years * 12)
+        self.by_type = dict.fromkeys(self.CHAT_TYPES, 0)
+        self.total = 0
+
+    def new_months(self) -> list:
+        """Пустая гистограмма для одного диалога, сливается через merge() после успешного прохода."""
+        return [0] * len(self.months)
+
+    def month_index(self, date: datetime) -> int:
+        index = (date.year - self.FIRST_YEAR) * 12 + date.month - 1
+        return min(max(index, 0), len(self.months) - 1)
+
+    def merge(self, dialog_id: int, title: str, chat_type: str, count: int, months: list):
+        self.total += count
+        self.by_type[chat_type] += count
+        for i, value in enumerate(months):
+            self.months[i] += value
+
+        if not count:
+            return
+        entry = (count, dialog_id, title)
+        if len(self.top) < self.top_n:
+            heapq.heappush(self.top, entry)
+        elif entry > self.top[0]:
+            heapq.heapreplace(self.top, entry)
+
+    def format(self) -> str:
+        lines = [f"<b>[CountMe]</b> Всего вы отправили <code>{self.total}</code> сообщений. <emoji document_id=5825794181183836432>✔️</emoji>", ""]
+
+        lines.append(f"<b>Топ-{self.top_n} чатов:</b>")
+        for count, _, title in sorted(self.top, reverse=True):
+            lines.append(f"  {title}: <code>{count}</code>")
+
+        lines.append("")
+        lines.append("<b>По типу чата:</b>")
+        type_names = {"user": "Личные", "group": "Группы", "channel": "Каналы"}
+        for chat_type in self.CHAT_TYPES:
+            lines.append(f"  {type_names[chat_type]}: <code>{self.by_type[chat_type]}</code>")
+
+        lines.append("")
+        lines.append("<b>По годам:</b>")
+        for year_offset in range(self.years):
+            year_count = sum(self.months[year_offset * 12:(year_offset + 1) * 12])
+            if year_count:
+                lines.append(f"  {self.FIRST_YEAR + year_offset}: <code>{year_count}</code>")
+
+        lines.append("")
+        lines.append("<b>За последние 12 месяцев:</b>")
+        now = datetime.now(timezone.utc)
+        current = self.month_index(now)
+        for index in range(max(current - 11, 0), current + 1):
+            year, month = divmod(index, 12)
+            lines.append(f"  {self.FIRST_YEAR + year}-{month + 1:02d}: <code>{self.months[index]}</code>")
+
+        return "\n".join(lines)
+
 
 @loader.tds
 class CountMeMod(loader.Module):
     """Считает ваши сообщения в чате и общее количество сообщений"""
     strings = {"name": "CountMe"}
 
+    # Как часто (в секундах) .ma сохраняет контрольную точку в базу
+    CHECKPOINT_INTERVAL = 30
+
+    def __init__(self):
+        self.config = loader.ModuleConfig(
+            loader.ConfigValue(
+                "concurrency",
+                4,
+                lambda: "Сколько диалогов .ma обрабатывает параллельно",
+                validator=loader.validators.Integer(minimum=1, maximum=32),
+            ),
+            loader.ConfigValue(
+                "progress_interval",
+                10,
+                lambda: "Минимальный интервал между обновлениями сообщения о прогрессе, в секундах",
+                validator=loader.validators.Integer(minimum=3),
+            ),
+        )
+
     async def on_install(self):
         """Вызывается при установке модуля."""
         await self.client.send_message(
@@ -27,23 +202,191 @@ class CountMeMod(loader.Module):
             "<b>[CountMe]</b> Модуль успешно установлен! Версия: 1.1.0 <emoji document_id=5825794181183836432>✔️</emoji>"
         )
 
-    @loader.command(ru_doc="Посчитать ваши сообщения в текущем чате")
+    async def _fast_count(self, entity, me_id: int, **kwargs):
+        """Возвращает количество ваших сообщений из поля count ответа поиска (один запрос) или None."""
+        # limit=0 запрашивает у Telegram только общее количество результатов, без самих сообщений
+        result = await self.client.get_messages(entity, limit=0, from_user=me_id, **kwargs)
+        return getattr(result, "total", None)
+
+    async def _count_dialog(self, entity, me_id: int, min_id: int = 0, max_id: int = 0) -> int:
+        """
+        Считает ваши сообщения в диалоге с id в (min_id, max_id) по count поиска — один запрос
+        на диалог, поэтому контрольной точке .ma достаточно списка завершённых диалогов.
+        """
+        count = await self._fast_count(entity, me_id, min_id=min_id, max_id=max_id)
+        if count is not None:
+            return count
+
+        count = 0
+        async for _ in self.client.iter_messages(entity, from_user=me_id, min_id=min_id, max_id=max_id):
+            count += 1
+        return count
+
+    async def _count_dialog_incremental(self, cache: dict, dialog_id: int, entity, top_id: int, me_id: int) -> int:
+        """
+        Считает диалог с учётом сохранённой записи [last_message_id, my_count]:
+        неизменившиеся диалоги пропускаются, у остальных считаются только новые сообщения.
+        """
+        key = str(dialog_id)
+        last_id, count = cache.get(key, (0, 0))
+        if last_id == top_id:
+            return count
+
+        # max_id фиксирует верхнюю границу, чтобы сообщения, пришедшие во время подсчёта,
+        # не были посчитаны повторно в следующий раз
+        count += await self._count_dialog(entity, me_id, min_id=last_id, max_id=top_id + 1)
+        cache[key] = [top_id, count]
+        return count
+
+    async def _scan_dialogs(self, status: Message, reporter: "_ProgressReporter", handle, skip=frozenset()):
+        """
+        Обходит все диалоги пулом из `concurrency` воркеров и вызывает `handle(dialog, top_id)` для каждого.
+        FloodWait в любом воркере ставит на паузу всех, после паузы диалог обрабатывается заново,
+        поэтому `handle` должен менять общее состояние только после успешного подсчёта.
+        """
+        concurrency = self.config["concurrency"]
+        queue = asyncio.Queue(maxsize=concurrency * 2)
+        gate = _FloodGate()
+
+        async def worker():
+            while (item := await queue.get()) is not None:
+                while True:
+                    await gate.wait()
+                    try:
+                        await handle(*item)
+                    except FloodWaitError as e:
+                        try:
+                            await self.client.edit_message(
+                                status.chat_id,
+                                status.id,
+                                f"<b>[CountMe]</b> Превышен лимит запросов Telegram. Пауза на {e.seconds} секунд... <emoji document_id=5778527486270770928>❌</emoji>"
+                            )
+                        except Exception:
+                            # Тот же текст от другого воркера или свой FloodWait на редактирование не должны ронять воркер
+                            pass
+                        # Пауза общая: остальные воркеры тоже ждут, затем диалог считается заново
+                        await gate.pause(e.seconds + 5)
+                        continue
+                    except Exception:
+                        # Игнорируем ошибки для отдельных диалогов (например, удаленные или недоступные пиры)
+                        pass
+                    break
+
+        # Список диалогов собираем один раз до начала подсчёта: по нему известен
+        # общий объём работы для ETA, а GetDialogs не запрашивается повторно
+        dialogs = []
+        async for dialog in self.client.iter_dialogs():
+            # Пропускаем служебные диалоги или те, где нет возможности получить сообщения
+            if not isinstance(dialog.entity, (Channel, Chat, User)):
+                continue
+            if dialog.id in skip:
+                continue
+            top_id = dialog.message.id if dialog.message else 0
+            dialogs.append((dialog, top_id))
+            reporter.add_span(top_id)
+
+        async def producer():
+            for item in dialogs:
+                await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        tasks = [asyncio.ensure_future(producer()), *workers]
+
+        try:
+            # Ошибка любой задачи сразу прерывает обход: продюсер не останется ждать
+            # места в очереди, которую уже никто не разбирает
+            await asyncio.gather(*tasks)
+        finally:
+            # При ошибке не оставляем продюсер и воркеры висеть в фоне
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def _parse_date(value: str):
+        """Разбирает дату в формате ГГГГ-ММ-ДД или ДД.ММ.ГГГГ (UTC). Возвращает None при ошибке."""
+        for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+            try:
+                return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+            except ValueError:
+                continue
+        return None
+
+    async def _id_before(self, entity, date: datetime) -> int:
+        """id последнего сообщения чата, отправленного раньше `date` (0, если такого нет)."""
+        # offset_date ищет границу на стороне сервера — один запрос вместо перебора истории
+        result = await self.client.get_messages(entity, limit=1, offset_date=date)
+        return result[0].id if result else 0
+
+    async def _me_range(self, message: Message, date_from: datetime, date_to: datetime):
+        """Считает ваши сообщения в текущем чате за период [date_from, date_to] включительно."""
+        initial_message = await utils.answer(message, "<b>[CountMe]</b> Считаю сообщения за период... <emoji document_id=5875465628285931233>✈️</emoji>")
+        me_id = (await self.client.get_me()).id
+
+        try:
+            # Переводим даты в границы id: (min_id, max_id) исключают сами граничные сообщения
+            min_id = await self._id_before(message.chat_id, date_from)
+            max_id = await self._id_before(message.chat_id, date_to + timedelta(days=1))
+            count = 0
+            if max_id > min_id:
+                count = await self._count_dialog(message.chat_id, me_id, min_id=min_id, max_id=max_id + 1)
+
+            await self.client.edit_message(
+                initial_message.chat_id,
+                initial_message.id,
+                f"<b>[CountMe]</b> С {date_from:%d.%m.%Y} по {date_to:%d.%m.%Y} у вас <code>{count}</code> сообщений в этом чате. <emoji document_id=5825794181183836432>✔️</emoji>",
+            )
+        except FloodWaitError as e:
+            await self.client.edit_message(
+                initial_message.chat_id,
+                initial_message.id,
+                f"<b>[CountMe]</b> Превышен лимит запросов Telegram. Попробуйте снова через {e.seconds} секунд. <emoji document_id=5778527486270770928>❌</emoji>"
+            )
+        except Exception as e:
+            await self.client.edit_message(
+                initial_message.chat_id,
+                initial_message.id,
+                f"<b>[CountMe]</b> Произошла ошибка при подсчете сообщений: <code>{e}</code> <emoji document_id=5778527486270770928>❌</emoji>"
+            )
+
+    @loader.command(ru_doc="Посчитать ваши сообщения в текущем чате (.me full — полный перебор для проверки, .me <с> <по> — за период, даты ГГГГ-ММ-ДД или ДД.ММ.ГГГГ)")
     async def me(self, message: Message):
         """Посчитать ваши сообщения в текущем чате <emoji document_id=5877482652302315100>📁</emoji>"""
+        args = utils.get_args(message)
+        if len(args) >= 2:
+            date_from, date_to = self._parse_date(args[0]), self._parse_date(args[1])
+            if date_from is None or date_to is None or date_from > date_to:
+                await utils.answer(message, "<b>[CountMe]</b> Укажите период датами ГГГГ-ММ-ДД или ДД.ММ.ГГГГ, например <code>.me 2024-01-01 2024-12-31</code>. <emoji document_id=5778527486270770928>❌</emoji>")
+                return
+            await self._me_range(message, date_from, date_to)
+            return
+
+        full_scan = bool(args) and args[0].lower() == "full"
+
         initial_message = await utils.answer(message, "<b>[CountMe]</b> Считаю сообщения в текущем чате... <emoji document_id=5875465628285931233>✈️</emoji>")
         
         count = 0
         me_id = (await self.client.get_me()).id
 
         try:
-            async for msg in self.client.iter_messages(message.chat_id, from_user=me_id):
-                count += 1
-                if count % 1000 == 0:
-                    await self.client.edit_message(
-                        initial_message.chat_id,
-                        initial_message.id,
-                        f"<b>[CountMe]</b> Подсчитано {count} сообщений в текущем чате... <emoji document_id=5900104897885376843>🕓</emoji>"
-                    )
+            if not full_scan:
+                # Быстрый режим: Telegram сам возвращает общее число найденных сообщений
+                count = await self._fast_count(message.chat_id, me_id)
+
+            if count is None or full_scan:
+                count = 0
+                reporter = _ProgressReporter(self.client, initial_message, self.config["progress_interval"])
+                # Сообщения идут от новых к старым, поэтому ETA считаем по пройденной части id от верхнего до 1
+                top = await self.client.get_messages(message.chat_id, limit=1)
+                top_id = top[0].id if top else 0
+                reporter.add_span(top_id)
+                previous_id = top_id
+                async for msg in self.client.iter_messages(message.chat_id, from_user=me_id):
+                    count += 1
+                    reporter.advance(messages=1, ids=previous_id - msg.id)
+                    previous_id = msg.id
+                    await reporter.report(f"Подсчитано {count} сообщений в текущем чате...")
 
             await self.client.edit_message(
                 initial_message.chat_id,
@@ -63,39 +406,103 @@ class CountMeMod(loader.Module):
                 f"<b>[CountMe]</b> Произошла ошибка при подсчете сообщений: <code>{e}</code> <emoji document_id=5778527486270770928>❌</emoji>"
             )
 
-    @loader.command(ru_doc="Посчитать все ваши сообщения во всех чатах Telegram", command="ma")
+    async def _ma_breakdown(self, message: Message, args: list):
+        """Один потоковый проход по всем вашим сообщениям с подробной сводкой."""
+        top_n = int(args[0]) if args and args[0].isdigit() else 10
+        initial_message = await utils.answer(message, "<b>[CountMe]</b> Собираю подробную сводку по всем вашим сообщениям. Это полный перебор и может занять много времени... <emoji document_id=5776213190387961618>🕓</emoji>")
+
+        me_id = (await self.client.get_me()).id
+        reporter = _ProgressReporter(self.client, initial_message, self.config["progress_interval"])
+        breakdown = _Breakdown(max(top_n, 1))
+
+        async def handle(dialog, top_id: int):
+            count = 0
+            months = breakdown.new_months()
+            async for msg in self.client.iter_messages(dialog.entity, from_user=me_id):
+                count += 1
+                months[breakdown.month_index(msg.date)] += 1
+
+            if dialog.is_user:
+                chat_type = "user"
+            elif dialog.is_group:
+                chat_type = "group"
+            else:
+                chat_type = "channel"
+            breakdown.merge(dialog.id, utils.escape_html(dialog.name or str(dialog.id)), chat_type, count, months)
+
+            reporter.advance(messages=count, ids=top_id)
+            await reporter.report(f"Подсчитано {breakdown.total} сообщений...")
+
+        try:
+            await self._scan_dialogs(initial_message, reporter, handle)
+            await self.client.edit_message(initial_message.chat_id, initial_message.id, breakdown.format())
+        except Exception as e:
+            await self.client.edit_message(
+                initial_message.chat_id,
+                initial_message.id,
+                f"<b>[CountMe]</b> Произошла ошибка при сборе сводки: <code>{e}</code> <emoji document_id=5778527486270770928>❌</emoji>"
+            )
+
+    @loader.command(ru_doc="Посчитать все ваши сообщения во всех чатах Telegram (.ma resume — продолжить прерванный подсчет, .ma breakdown [N] — подробная сводка)", command="ma")
     async def ma(self, message: Message):
         """Посчитать все ваши сообщения во всех чатах Telegram <emoji document_id=5877316724830768997>🗃</emoji>"""
-        initial_message = await utils.answer(message, "<b>[CountMe]</b> Начинаю подсчет всех ваших сообщений в Telegram. Это может занять много времени... <emoji document_id=5776213190387961618>🕓</emoji>")
+        args = utils.get_args(message)
+        if args and args[0].lower() == "breakdown":
+            await self._ma_breakdown(message, args[1:])
+            return
+
+        resume = bool(args) and args[0].lower() == "resume"
+
+        # Контрольная точка на уровне диалогов: завершённые диалоги и их сумма.
+        # Каждый диалог считается одним запросом, поэтому незаконченных переборов не бывает
+        # и продолжение повторяет не больше одного диалога на воркер
+        checkpoint = self.get("checkpoint") if resume else None
+        if resume and not checkpoint:
+            await utils.answer(message, "<b>[CountMe]</b> Нет прерванного подсчета для продолжения. <emoji document_id=5778527486270770928>❌</emoji>")
+            return
+        checkpoint = checkpoint or {"done": [], "total": 0}
+
+        if resume:
+            initial_message = await utils.answer(message, f"<b>[CountMe]</b> Продолжаю подсчет: уже обработано {len(checkpoint['done'])} диалогов... <emoji document_id=5776213190387961618>🕓</emoji>")
+        else:
+            initial_message = await utils.answer(message, "<b>[CountMe]</b> Начинаю подсчет всех ваших сообщений в Telegram. Это может занять много времени... <emoji document_id=5776213190387961618>🕓</emoji>")
         
-        total_messages = 0
+        done = set(checkpoint["done"])
+        total_messages = checkpoint["total"]
+        dialogs_done = len(done)
+        last_checkpoint = time.monotonic()
+        reporter = _ProgressReporter(self.client, initial_message, self.config["progress_interval"])
         me_id = (await self.client.get_me()).id
+        # Кэш по диалогам: {dialog_id: [last_message_id, my_count]}
+        cache = self.get("dialogs", {})
+
+        def save_checkpoint():
+            nonlocal last_checkpoint
+            last_checkpoint = time.monotonic()
+            self.set("dialogs", cache)
+            self.set("checkpoint", {"done": list(done), "total": total_messages})
+
+        async def handle(dialog, top_id: int):
+            nonlocal total_messages, dialogs_done
+            counted = await self._count_dialog_incremental(cache, dialog.id, dialog.entity, top_id, me_id)
+            total_messages += counted
+            done.add(dialog.id)
+            dialogs_done += 1
+            if time.monotonic() - last_checkpoint >= self.CHECKPOINT_INTERVAL:
+                save_checkpoint()
+            reporter.advance(messages=counted, ids=top_id)
+            await reporter.report(f"Обработано {dialogs_done} диалогов, подсчитано {total_messages} сообщений...")
 
         try:
-            async for dialog in self.client.iter_dialogs():
-                # Пропускаем служебные диалоги или те, где нет возможности получить сообщения
-                if not isinstance(dialog.entity, (Channel, Chat, User)):
-                    continue
-
-                try:
-                    async for msg in self.client.iter_messages(dialog.entity, from_user=me_id):
-                        total_messages += 1
-                        if total_messages % 10000 == 0:
-                            await self.client.edit_message(
-                                initial_message.chat_id,
-                                initial_message.id,
-                                f"<b>[CountMe]</b> Подсчитано {total_messages} сообщений... <emoji document_id=5900104897885376843>🕓</emoji>"
-                            )
-                except FloodWaitError as e:
-                    await self.client.edit_message(
-                        initial_message.chat_id,
-                        initial_message.id,
-                        f"<b>[CountMe]</b> Превышен лимит запросов Telegram. Пауза на {e.seconds} секунд... <emoji document_id=5778527486270770928>❌</emoji>"
-                    )
-                    await asyncio.sleep(e.seconds + 5)
-                except Exception:
-                    # Игнорируем ошибки для отдельных диалогов (например, удаленные или недоступные пиры)
-                    pass 
+            try:
+                # При продолжении пропускаем диалоги, уже учтённые в контрольной точке
+                await self._scan_dialogs(initial_message, reporter, handle, skip=done)
+                self.set("dialogs", cache)
+                self.set("checkpoint", None)
+            except BaseException:
+                # Сохраняем сделанное, чтобы .ma resume продолжил с этого места
+                save_checkpoint()
+                raise
 
             await self.client.edit_message(
                 initial_message.chat_id,
@@ -106,11 +513,11 @@ class CountMeMod(loader.Module):
             await self.client.edit_message(
                 initial_message.chat_id,
                 initial_message.id,
-                f"<b>[CountMe]</b> Превышен лимит запросов Telegram. Попробуйте снова через {e.seconds} секунд. <emoji document_id=5778527486270770928>❌</emoji>"
+                f"<b>[CountMe]</b> Превышен лимит запросов Telegram. Продолжите через {e.seconds} секунд командой <code>.ma resume</code>. <emoji document_id=5778527486270770928>❌</emoji>"
             )
         except Exception as e:
             await self.client.edit_message(
                 initial_message.chat_id,
                 initial_message.id,
-                f"<b>[CountMe]</b> Произошла общая ошибка при подсчете всех сообщений: <code>{e}</code> <emoji document_id=5778527486270770928>❌</emoji>"
+                f"<b>[CountMe]</b> Произошла общая ошибка при подсчете всех сообщений: <code>{e}</code>. Продолжить: <code>.ma resume</code> <emoji document_id=5778527486270770928>❌</emoji>"
             )
\ No newline at end of file
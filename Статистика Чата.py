@@ -1,11 +1,548 @@
 # meta developer: @Androfon_AI
 # meta name: Статистика Чата
 # meta version: 1.3.9
+# requires: numpy
 
+import asyncio
 import logging
+import math
+import os
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+import numpy as np
 from telethon import events
-from telethon.tl.types import Channel, Chat, User, MessageActionTopicCreate, Message
-from .. import loader
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.channels import GetForumTopicsRequest
+from telethon.tl.functions.messages import GetSearchCountersRequest
+from telethon.tl.types import (
+    Channel,
+    Chat,
+    User,
+    MessageActionTopicCreate,
+    MessageActionChatAddUser,
+    MessageActionChatJoinedByLink,
+    MessageActionChatJoinedByRequest,
+    MessageActionChatDeleteUser,
+    Message,
+    MessageReplyHeader,
+    InputMessagesFilterPhotos,
+    InputMessagesFilterVideo,
+    InputMessagesFilterDocument,
+    InputMessagesFilterVoice,
+    InputMessagesFilterRoundVideo,
+    ForumTopic,
+    MessageMediaPhoto,
+    MessageMediaDocument,
+    MessageMediaWebPage,
+    Photo,
+    Document,
+    WebPage,
+    DocumentAttributeVideo,
+    DocumentAttributeAudio,
+    DocumentAttributeAnimated,
+    DocumentAttributeSticker,
+)
+from .. import loader, utils
+
+# Порядок полей в шаблонах "chat_stats" и "topic_stats"
+COUNT_FIELDS = ("total", "photo", "video", "file", "voice", "video_note")
+
+# Код класса медиа для компактного хранения: 0 — без учитываемого медиа, далее по порядку полей
+MEDIA_CODES = {field: code for code, field in enumerate(COUNT_FIELDS[1:], 1)}
+
+# Фильтры поиска Telegram, соответствующие полям статистики
+SEARCH_FILTERS = {
+    "photo": InputMessagesFilterPhotos,
+    "video": InputMessagesFilterVideo,
+    "file": InputMessagesFilterDocument,
+    "voice": InputMessagesFilterVoice,
+    "video_note": InputMessagesFilterRoundVideo,
+}
+
+
+def _photo_media(media):
+    return (media.photo if isinstance(media.photo, Photo) else None), None
+
+
+def _document_media(media):
+    return None, (media.document if isinstance(media.document, Document) else None)
+
+
+def _web_page_media(media):
+    webpage = media.webpage
+    if not isinstance(webpage, WebPage):
+        return None, None
+    return (
+        webpage.photo if isinstance(webpage.photo, Photo) else None,
+        webpage.document if isinstance(webpage.document, Document) else None,
+    )
+
+
+# Извлечение (photo, document) по типу медиа — так же, как свойства Message.photo и Message.document
+MEDIA_EXTRACTORS = {
+    MessageMediaPhoto: _photo_media,
+    MessageMediaDocument: _document_media,
+    MessageMediaWebPage: _web_page_media,
+}
+
+
+def classify_media(msg) -> str | None:
+    """
+    Поле статистики для медиа сообщения или None, если оно не учитывается.
+
+    Даёт тот же результат, что цепочка msg.video_note / voice / video / photo /
+    document (без gif и стикеров), но тип медиа определяется одним поиском в
+    словаре, а атрибуты документа просматриваются один раз вместо семи.
+    """
+    extractor = MEDIA_EXTRACTORS.get(type(msg.media))
+    if extractor is None:
+        return None
+
+    photo, document = extractor(msg.media)
+    animated = sticker = False
+    if document is not None:
+        video = audio = None
+        for attr in document.attributes:
+            # Свойства Telethon смотрят только на первый атрибут каждого типа
+            attr_type = type(attr)
+            if attr_type is DocumentAttributeVideo:
+                video = video or attr
+            elif attr_type is DocumentAttributeAudio:
+                audio = audio or attr
+            elif attr_type is DocumentAttributeAnimated:
+                animated = True
+            elif attr_type is DocumentAttributeSticker:
+                sticker = True
+
+        if video is not None and video.round_message:
+            return "video_note"
+        if audio is not None and audio.voice:
+            return "voice"
+        if video is not None:
+            return "video"
+
+    if photo is not None:
+        return "photo"
+    if document is not None and not animated and not sticker:
+        return "file"
+    return None
+
+
+class _SpaceSaving:
+    """
+    Скетч Space-Saving для самых активных отправителей: хранит не больше
+    `capacity` счётчиков, поэтому память не зависит от числа участников.
+    Для каждого элемента помнит завышение `error`; элементы с count - error
+    выше порога гарантированно входят в число самых частых.
+    Элементы сгруппированы в корзины по значению счётчика (stream-summary),
+    поэтому и увеличение, и вытеснение минимального — O(1).
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # {count: {item: None}} — словарь как упорядоченное множество
+        self._buckets = {}
+        self._min = 0
+
+    def _place(self, item, count: int):
+        self.counts[item] = count
+        self._buckets.setdefault(count, {})[item] = None
+
+    def _unplace(self, item, count: int):
+        bucket = self._buckets[count]
+        del bucket[item]
+        if not bucket:
+            del self._buckets[count]
+
+    def add(self, item):
+        count = self.counts.get(item)
+        if count is not None:
+            self._unplace(item, count)
+            self._place(item, count + 1)
+            if count == self._min and count not in self._buckets:
+                self._min = count + 1
+            return
+
+        if len(self.counts) < self.capacity:
+            self._place(item, 1)
+            self.errors[item] = 0
+            self._min = 1
+            return
+
+        # Вытесняем элемент с минимальным счётчиком, новый наследует его значение
+        floor = self._min
+        victim = next(iter(self._buckets[floor]))
+        self._unplace(victim, floor)
+        del self.counts[victim]
+        del self.errors[victim]
+        self._place(item, floor + 1)
+        self.errors[item] = floor
+        if floor not in self._buckets:
+            self._min = floor + 1
+
+    def top(self, k: int) -> list:
+        """Список (item, count, error) по убыванию count."""
+        ranked = sorted(self.counts.items(), key=lambda entry: entry[1], reverse=True)[:k]
+        return [(item, count, self.errors[item]) for item, count in ranked]
+
+
+class _HyperLogLog:
+    """HyperLogLog для оценки числа различных отправителей: 2**p однобайтовых регистров."""
+
+    def __init__(self, p: int = 12):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    @staticmethod
+    def _hash(value: int) -> int:
+        # splitmix64: быстрое перемешивание целого id в равномерные 64 бита
+        value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        return value ^ (value >> 31)
+
+    def add(self, value: int):
+        hashed = self._hash(value)
+        index = hashed >> (64 - self.p)
+        rest = hashed & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self) -> int:
+        estimate = self.alpha * self.m * self.m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        # Поправка для малых значений: линейный подсчёт по пустым регистрам
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return round(estimate)
+
+
+class _SenderStats:
+    """Топ отправителей и число уникальных отправителей за один проход, фиксированная память."""
+
+    def __init__(self, top_k: int):
+        self.top_k = top_k
+        # Запас счётчиков повышает точность верхушки рейтинга
+        self.heavy_hitters = _SpaceSaving(top_k * 10)
+        self.unique = _HyperLogLog()
+
+    def add_message(self, msg):
+        sender_id = msg.sender_id
+        if sender_id is None:
+            return
+        self.heavy_hitters.add(sender_id)
+        self.unique.add(sender_id)
+
+
+class _ActivityColumns:
+    """
+    Компактные колонки сообщений для отчёта об активности: дата (int32),
+    отправитель (int64) и класс медиа (uint8) — 13 байт на сообщение.
+    Буферы выделяются заранее и растут удвоением.
+    """
+
+    def __init__(self, capacity: int = 1 << 16):
+        self.size = 0
+        self.dates = np.empty(capacity, dtype=np.int32)
+        self.senders = np.empty(capacity, dtype=np.int64)
+        self.media = np.empty(capacity, dtype=np.uint8)
+
+    def _grow(self):
+        capacity = len(self.dates) * 2
+        for name in ("dates", "senders", "media"):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def add_message(self, msg):
+        if self.size == len(self.dates):
+            self._grow()
+        index = self.size
+        self.dates[index] = int(msg.date.timestamp())
+        self.senders[index] = msg.sender_id or 0
+        self.media[index] = MEDIA_CODES.get(classify_media(msg), 0)
+        self.size += 1
+
+    def columns(self):
+        return self.dates[:self.size], self.senders[:self.size], self.media[:self.size]
+
+
+# id топика «General»: в форуме в него попадают все сообщения без заголовка топика
+GENERAL_TOPIC_ID = 1
+
+
+def topic_of(msg) -> int:
+    """id топика форума, к которому относится сообщение (вне форумов — GENERAL_TOPIC_ID)."""
+    reply_to = msg.reply_to
+    if isinstance(reply_to, MessageReplyHeader) and reply_to.forum_topic:
+        return reply_to.reply_to_top_id or reply_to.reply_to_msg_id
+    if isinstance(msg.action, MessageActionTopicCreate):
+        return msg.id
+    return GENERAL_TOPIC_ID
+
+
+class _MessageIndex:
+    """
+    Локальный индекс метаданных сообщений в SQLite (режим WAL).
+    Краулер пишет строки пачками через executemany, статистика считается SQL-агрегацией без сети.
+    """
+
+    BATCH_SIZE = 1000
+
+    # Колонки агрегатов в порядке COUNT_FIELDS
+    _AGGREGATES = ", ".join(
+        ["COUNT(*)"] + [f"SUM(media_class = {MEDIA_CODES[field]})" for field in COUNT_FIELDS[1:]]
+    )
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                chat_id INTEGER NOT NULL,
+                msg_id INTEGER NOT NULL,
+                date INTEGER NOT NULL,
+                sender_id INTEGER,
+                media_class INTEGER NOT NULL,
+                topic_id INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, msg_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS messages_topic ON messages (chat_id, topic_id);
+            CREATE TABLE IF NOT EXISTS topics (
+                chat_id INTEGER NOT NULL,
+                topic_id INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                PRIMARY KEY (chat_id, topic_id)
+            );
+            CREATE TABLE IF NOT EXISTS crawled (
+                chat_id INTEGER PRIMARY KEY,
+                last_id INTEGER NOT NULL
+            );
+            """
+        )
+        self._rows = []
+        self._topics = []
+
+    def close(self):
+        self.connection.close()
+
+    def add_message(self, chat_id: int, msg):
+        self._rows.append((
+            chat_id,
+            msg.id,
+            int(msg.date.timestamp()),
+            msg.sender_id,
+            MEDIA_CODES.get(classify_media(msg), 0),
+            topic_of(msg),
+        ))
+        if isinstance(msg.action, MessageActionTopicCreate):
+            self._topics.append((chat_id, msg.id, msg.action.title))
+        if len(self._rows) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)", self._rows)
+            self.connection.executemany("INSERT OR REPLACE INTO topics VALUES (?, ?, ?)", self._topics)
+        self._rows.clear()
+        self._topics.clear()
+
+    def last_id(self, chat_id: int) -> int | None:
+        """Последний проиндексированный id или None, если чат ещё не индексировался."""
+        row = self.connection.execute("SELECT last_id FROM crawled WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def mark_crawled(self, chat_id: int, last_id: int):
+        self.flush()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO crawled VALUES (?, ?)", (chat_id, last_id))
+
+    def counts(self, chat_id: int, topic_id: int = None) -> dict:
+        query = f"SELECT {self._AGGREGATES} FROM messages WHERE chat_id = ?"
+        params = [chat_id]
+        if topic_id is not None:
+            query += " AND topic_id = ?"
+            params.append(topic_id)
+        row = self.connection.execute(query, params).fetchone()
+        return {field: value or 0 for field, value in zip(COUNT_FIELDS, row)}
+
+    def topic_counts(self, chat_id: int) -> list:
+        """Список (title, counts) по всем топикам, включая «General», отсортированный по числу сообщений."""
+        rows = self.connection.execute(
+            f"SELECT m.topic_id, t.title, {self._AGGREGATES} FROM messages m "
+            "LEFT JOIN topics t ON t.chat_id = m.chat_id AND t.topic_id = m.topic_id "
+            "WHERE m.chat_id = ? GROUP BY m.topic_id ORDER BY COUNT(*) DESC",
+            (chat_id,),
+        ).fetchall()
+        return [
+            (title or ("General" if topic_id == GENERAL_TOPIC_ID else f"ID: {topic_id}"), dict(zip(COUNT_FIELDS, values)))
+            for topic_id, title, *values in rows
+        ]
+
+
+class _TTLCache:
+    """LRU-кэш с истечением записей по времени: при переполнении вытесняется самая давняя."""
+
+    def __init__(self):
+        self._items = OrderedDict()
+
+    def get(self, key, ttl: float):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, stored_at = item
+        if time.monotonic() - stored_at > ttl:
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value, size: int):
+        self._items[key] = (value, time.monotonic())
+        self._items.move_to_end(key)
+        while len(self._items) > size:
+            self._items.popitem(last=False)
+
+    def adjust(self, key, delta: int):
+        """Поправка к закэшированному значению без продления срока жизни записи."""
+        item = self._items.get(key)
+        if item is not None:
+            value, stored_at = item
+            self._items[key] = (max(value + delta, 0), stored_at)
+
+
+def membership_delta(event) -> int:
+    """
+    Изменение числа участников по событию events.ChatAction. Если событие пришло
+    служебным сообщением, считаем по его action, иначе — по флагам самого события.
+    """
+    action = getattr(event.action_message, "action", None)
+    if isinstance(action, MessageActionChatAddUser):
+        return len(action.users)
+    if isinstance(action, (MessageActionChatJoinedByLink, MessageActionChatJoinedByRequest)):
+        return 1
+    if isinstance(action, MessageActionChatDeleteUser):
+        return -1
+    users = len(event.user_ids or ()) or 1
+    if event.user_joined or event.user_added:
+        return users
+    if event.user_left or event.user_kicked:
+        return -users
+    return 0
+
+
+class _FloodGate:
+    """Общая пауза для всех параллельных сканеров: FloodWait останавливает всех сразу."""
+
+    def __init__(self):
+        self._open = asyncio.Event()
+        self._open.set()
+        self._until = 0.0
+
+    async def wait(self):
+        await self._open.wait()
+
+    async def pause(self, seconds: float):
+        until = time.monotonic() + seconds
+        if until <= self._until:
+            await self.wait()
+            return
+
+        self._until = until
+        if not self._open.is_set():
+            await self.wait()
+            return
+
+        self._open.clear()
+        while (remaining := self._until - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+        self._open.set()
+
+
+class _AdaptivePacer:
+    """
+    Темп постраничного чтения истории, общий для всех шардов одного скана.
+    Telethon сам пережидает короткие FloodWait внутри запроса, поэтому троттлинг
+    обычно виден как медленный ответ: и он, и явный FloodWait увеличивают паузу
+    между запросами, а быстрые ответы её плавно убирают. Лимит считается по числу
+    запросов, поэтому страница при троттлинге остаётся максимальной и уменьшается
+    только после сбоев запроса (таймауты, обрывы), пока ответы снова не пойдут.
+    """
+
+    MAX_BATCH = 100
+    MIN_BATCH = 20
+    BATCH_STEP = 10
+    # Ответ медленнее этого порога и нескольких обычных задержек считается троттлингом
+    SLOW_LATENCY = 2.0
+    SLOW_FACTOR = 3
+    MIN_DELAY = 0.5
+    MAX_DELAY = 5.0
+    DELAY_DECAY = 0.8
+
+    def __init__(self):
+        self.gate = _FloodGate()
+        self.batch = self.MAX_BATCH
+        self.delay = 0.0
+        # Скользящее среднее задержки обычного ответа
+        self.latency = None
+
+    def _throttled(self):
+        self.delay = min(max(self.delay * 2, self.MIN_DELAY), self.MAX_DELAY)
+
+    def failed(self):
+        """Запрос упал не из-за FloodWait: следующая страница будет меньше."""
+        self.batch = max(self.batch // 2, self.MIN_BATCH)
+
+    async def fetch(self, request):
+        """
+        Выполняет request(limit) с текущими темпом и размером страницы.
+        Возвращает (страница, limit) или None, если запрос упёрся в FloodWait и его нужно повторить.
+        """
+        await self.gate.wait()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        limit = self.batch
+        started = time.monotonic()
+        try:
+            page = await request(limit)
+        except FloodWaitError as e:
+            self._throttled()
+            await self.gate.pause(e.seconds)
+            return None
+
+        latency = time.monotonic() - started
+        self.batch = min(self.batch + self.BATCH_STEP, self.MAX_BATCH)
+        if latency > self.SLOW_LATENCY and (self.latency is None or latency > self.SLOW_FACTOR * self.latency):
+            # Скорее всего, Telethon молча переждал FloodWait
+            self._throttled()
+            return page, limit
+
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        # Пауза затухает, пока не станет пренебрежимо малой
+        self.delay *= self.DELAY_DECAY
+        if self.delay < 0.05:
+            self.delay = 0.0
+        return page, limit
+
+
+class _ScanInterrupted(Exception):
+    """Скан прерван ошибкой; counts — то, что успели посчитать до неё."""
+
+    def __init__(self, counts: dict):
+        super().__init__("скан прерван")
+        self.counts = counts
+
 
 class ChatStatsMod(loader.Module):
     """
@@ -35,23 +572,661 @@ class ChatStatsMod(loader.Module):
             "<emoji document_id=5897554554894946515>🎤</emoji> <b>Голосовых сообщений:</b> <code>{}</code>\n"
             "<emoji document_id=5931757531251612084>📷</emoji> <b>Видеосообщений:</b> <code>{}</code>"
         ),
-        "chat_stats_desc": "Показывает подробную статистику текущего чата или топика: количество участников (для чата), сообщений, фото, видео, файлов, голосовых и видеосообщений."
+        "chat_stats_desc": "Показывает подробную статистику текущего чата или топика: количество участников (для чата), сообщений, фото, видео, файлов, голосовых и видеосообщений.",
+        "unavailable": "Недоступно",
+        "index_enabled": "<emoji document_id=5825794181183836432>✔️</emoji> Индекс статистики для этого чата построен. Новые сообщения будут учитываться автоматически.",
+        "index_disabled": "<emoji document_id=5825794181183836432>✔️</emoji> Индекс статистики для этого чата удалён.",
+        "index_building": "<emoji document_id=5900104897885376843>🕓</emoji> Строю индекс статистики чата, пожалуйста, подождите...",
+        "index_failed": "<emoji document_id=5778527486270770928>❌</emoji> Не удалось построить индекс статистики чата.",
+        "not_forum": "❗️ Эта команда работает только в форумах.",
+        "collecting_activity": "<emoji document_id=5900104897885376843>🕓</emoji> Собираю активность чата, пожалуйста, подождите...",
+        "activity_empty": "❗️ Не удалось собрать активность: сообщений нет или история недоступна.",
+        "activity_stats": (
+            "<emoji document_id=5877485980901971030>📊</emoji> <b>Активность чата</b> (время UTC)\n\n"
+            "<emoji document_id=5886666250158870040>💬</emoji> <b>Сообщений:</b> <code>{}</code>\n"
+            "<emoji document_id=5771887475421090729>👤</emoji> <b>Писали:</b> <code>{}</code>\n\n"
+            "<b>По дням недели и часам (0–23):</b>\n<code>{}</code>\n\n"
+            "<b>Последние 30 дней:</b> <code>{}</code>\n"
+            "<b>В среднем в день:</b> <code>{}</code>, <b>самый активный день:</b> <code>{}</code> (<code>{}</code>)\n\n"
+            "<b>Доля медиа по месяцам:</b>\n<code>{}</code>"
+        ),
+        "crawling": "<emoji document_id=5900104897885376843>🕓</emoji> Индексирую историю чата в локальную базу, пожалуйста, подождите...",
+        "crawl_done": "<emoji document_id=5825794181183836432>✔️</emoji> Локальный индекс обновлён, добавлено сообщений: <code>{}</code>. Статистика этого чата теперь считается без запросов к Telegram; для учёта новых сообщений повторите <code>.chatstats crawl</code>.",
+        "crawl_failed": "<emoji document_id=5778527486270770928>❌</emoji> Не удалось проиндексировать историю чата.",
+        "partial_stats": "\n\n<emoji document_id=5778527486270770928>❌</emoji> <i>Подсчёт прерван ошибкой, показаны неполные данные.</i>",
+        "senders_header": "\n\n<emoji document_id=5771887475421090729>👤</emoji> <b>Писали в чат (оценка):</b> <code>{}</code>\n<b>Самые активные:</b>",
+        "senders_row": "{}. <a href='tg://user?id={}'>{}</a>: <code>{}</code>",
+        "collecting_topics_stats": "<emoji document_id=5900104897885376843>🕓</emoji> Собираю статистику всех топиков, пожалуйста, подождите...",
+        "topics_stats_header": "<emoji document_id=5877485980901971030>📊</emoji> <b>Статистика топиков ({}):</b>\n",
+        "topics_stats_row": "<b>{}</b>: 💬 <code>{}</code> · 🖼 <code>{}</code> · 🎥 <code>{}</code> · 💾 <code>{}</code> · 🎤 <code>{}</code> · 📷 <code>{}</code>",
+        "topics_stats_more": "<i>…и ещё {} топиков</i>",
     }
 
+    # Не чаще чем раз в столько секунд watcher сохраняет индекс в базу
+    INDEX_SAVE_INTERVAL = 60
+    # Сколько сообщений за разрывом watcher держит в ожидании догонки на чат
+    STAGED_LIMIT = 1000
+
     strings_doc = {
         "chatstats": (
             "Показывает подробную статистику текущего чата или топика.\n"
             "Используйте в обычном чате для статистики всего чата, или в топике "
             "(отвечая на сообщение в топике или отправляя команду прямо в топике) "
             "для статистики конкретного топика. "
-            "Включает количество участников (для чата), сообщений, фото, видео, файлов, голосовых и видеосообщений."
+            "Включает количество участников (для чата), сообщений, фото, видео, файлов, голосовых и видеосообщений.\n"
+            "По умолчанию счётчики берутся у Telegram одним запросом; "
+            "<code>.chatstats exact</code> — точный подсчёт перебором всей истории, "
+            "с самыми активными участниками и оценкой числа писавших.\n"
+            "<code>.chatstats index</code> — построить сохраняемый индекс чата, который дальше обновляется "
+            "по новым сообщениям и отвечает мгновенно; <code>.chatstats index off</code> — удалить его.\n"
+            "<code>.chatstats topics</code> — статистика сразу всех топиков форума, отсортированная по числу сообщений.\n"
+            "<code>.chatstats ~</code> — приблизительная оценка по случайным окнам истории с погрешностью (95%).\n"
+            "<code>.chatstats activity</code> — тепловая карта по часам и дням недели, сообщения по дням и доля медиа по месяцам.\n"
+            "<code>.chatstats crawl</code> — сохранить метаданные сообщений в локальную SQLite-базу (повторный запуск добавляет новые); "
+            "после этого статистика чата и топиков считается локально, на момент последнего crawl."
         )
     }
 
+    def __init__(self):
+        self.config = loader.ModuleConfig(
+            loader.ConfigValue(
+                "scan_shards",
+                8,
+                lambda: "На сколько диапазонов id делить историю при точном подсчёте",
+                validator=loader.validators.Integer(minimum=1, maximum=64),
+            ),
+            loader.ConfigValue(
+                "scan_concurrency",
+                4,
+                lambda: "Сколько диапазонов id сканировать одновременно",
+                validator=loader.validators.Integer(minimum=1, maximum=16),
+            ),
+            loader.ConfigValue(
+                "approx_error",
+                0.01,
+                lambda: "Целевая погрешность приблизительного режима (~) как доля от общего числа сообщений",
+                validator=loader.validators.Float(minimum=0.001, maximum=0.5),
+            ),
+            loader.ConfigValue(
+                "approx_budget",
+                100,
+                lambda: "Максимум запросов-выборок в приблизительном режиме (~)",
+                validator=loader.validators.Integer(minimum=5, maximum=1000),
+            ),
+            loader.ConfigValue(
+                "top_senders",
+                10,
+                lambda: "Сколько самых активных участников показывать в точном режиме",
+                validator=loader.validators.Integer(minimum=0, maximum=50),
+            ),
+            loader.ConfigValue(
+                "participants_cache_ttl",
+                600,
+                lambda: "Сколько секунд хранить количество участников чата в кэше",
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "participants_cache_size",
+                256,
+                lambda: "Сколько чатов держать в кэше количества участников",
+                validator=loader.validators.Integer(minimum=1),
+            ),
+            loader.ConfigValue(
+                "sqlite_path",
+                os.path.join(os.path.expanduser("~"), ".chatstats.sqlite3"),
+                lambda: "Путь к файлу локального SQLite-индекса сообщений (.chatstats crawl)",
+            ),
+        )
+
     async def client_ready(self, client, db):
         self.client = client
         self.db = db
         self.logger = logging.getLogger(__name__)
+        # Индекс по чатам: {chat_id: {"last_indexed_id": ..., "total": ..., "photo": ..., ...}}
+        self._index = {int(chat_id): record for chat_id, record in self.get("index", {}).items()}
+        self._index_saved_at = time.monotonic()
+        # Сообщения, пришедшие через watcher после разрыва в индексе: {chat_id: {msg_id: поле медиа}}.
+        # Учитываются, только когда last_indexed_id доходит до них без пропусков
+        self._staged = {}
+        # Локальный SQLite-индекс открывается лениво, при первом обращении
+        self._sqlite = None
+        # Количество участников по chat_id; между обновлениями поправляется по входам и выходам
+        self._participants = _TTLCache()
+        # Служебные сообщения о входе и выходе не доходят до watcher (NewMessage их отбрасывает),
+        # поэтому слушаем ChatAction отдельно
+        client.add_event_handler(self._on_chat_action, events.ChatAction())
+
+    async def on_unload(self):
+        self.client.remove_event_handler(self._on_chat_action, events.ChatAction())
+        self._save_index()
+        if self._sqlite is not None:
+            self._sqlite.close()
+
+    def _open_sqlite(self) -> _MessageIndex:
+        if self._sqlite is None:
+            self._sqlite = _MessageIndex(self.config["sqlite_path"])
+        return self._sqlite
+
+    def _sqlite_has(self, chat_id: int) -> bool:
+        """Есть ли чат в локальном индексе (файл открывается, только если уже существует)."""
+        if self._sqlite is None and not os.path.exists(self.config["sqlite_path"]):
+            return False
+        return self._open_sqlite().last_id(chat_id) is not None
+
+    async def _crawl(self, chat, chat_id: int) -> int:
+        """
+        Дописывает в SQLite-индекс сообщения новее последнего проиндексированного
+        (в первый раз — всю историю). Возвращает число добавленных сообщений.
+        """
+        index = self._open_sqlite()
+        last_id = index.last_id(chat_id) or 0
+        counts, top_id = await self._scan_exact(
+            chat,
+            on_message=lambda msg: index.add_message(chat_id, msg),
+            min_id=last_id,
+        )
+        index.mark_crawled(chat_id, max(top_id, last_id))
+        return counts["total"]
+
+    async def _crawl_command(self, message: Message, chat):
+        await message.edit(self.strings("crawling"))
+        index = self._open_sqlite()
+        try:
+            added = await self._crawl(chat, message.chat_id)
+        except Exception as e:
+            self.logger.error(f"Ошибка при индексации чата {chat.id} в SQLite: {e}")
+            # Уже собранные строки сохраняем; отметку не двигаем, повторный crawl перезапишет их без дублей
+            index.flush()
+            await message.edit(self.strings("crawl_failed"))
+            return
+        await message.edit(self.strings("crawl_done").format(added))
+
+    def _save_index(self):
+        self._index_saved_at = time.monotonic()
+        self.set("index", {str(chat_id): record for chat_id, record in self._index.items()})
+
+    def _index_message(self, record: dict, msg):
+        self._index_field(record, msg.id, classify_media(msg))
+
+    @staticmethod
+    def _index_field(record: dict, msg_id: int, field: str | None):
+        record["total"] += 1
+        if field:
+            record[field] += 1
+        if msg_id > record["last_indexed_id"]:
+            record["last_indexed_id"] = msg_id
+
+    def _fold_staged(self, chat_id: int, record: dict):
+        """
+        Переносит в индекс отложенные сообщения, идущие подряд сразу за last_indexed_id.
+        Отложенные с id не больше курсора уже учтены догонкой и просто отбрасываются.
+        """
+        staged = self._staged.get(chat_id)
+        if not staged:
+            return
+        for msg_id in [msg_id for msg_id in staged if msg_id <= record["last_indexed_id"]]:
+            del staged[msg_id]
+        while (msg_id := record["last_indexed_id"] + 1) in staged:
+            self._index_field(record, msg_id, staged.pop(msg_id))
+
+    async def _on_chat_action(self, event):
+        delta = membership_delta(event)
+        if delta:
+            self._participants.adjust(event.chat_id, delta)
+
+    @loader.watcher()
+    async def watcher(self, message: Message):
+        record = self._index.get(message.chat_id)
+        if record is None or message.id <= record["last_indexed_id"]:
+            return
+
+        # Курсор двигаем только без разрывов: сообщения, пришедшие пока модуль был выгружен,
+        # иначе потерялись бы навсегда. Остальное ждёт догонки в _count_indexed
+        staged = self._staged.setdefault(message.chat_id, {})
+        if len(staged) < self.STAGED_LIMIT or message.id == record["last_indexed_id"] + 1:
+            staged[message.id] = classify_media(message)
+        self._fold_staged(message.chat_id, record)
+        if time.monotonic() - self._index_saved_at >= self.INDEX_SAVE_INTERVAL:
+            self._save_index()
+
+    async def _build_index(self, chat) -> dict:
+        """Строит запись индекса полным перебором истории."""
+        record, top_id = await self._scan_exact(chat)
+        record["last_indexed_id"] = top_id
+        return record
+
+    async def _count_indexed(self, chat, chat_id: int, record: dict) -> dict:
+        """Догоняет индекс по сообщениям новее last_indexed_id и возвращает счётчики."""
+        # От старых к новым: если догонка прервётся, last_indexed_id не перепрыгнет пропущенные сообщения
+        async for msg in self.client.iter_messages(chat, min_id=record["last_indexed_id"], reverse=True, limit=None):
+            if msg.id > record["last_indexed_id"]:
+                self._index_message(record, msg)
+        self._fold_staged(chat_id, record)
+        self._save_index()
+        return record
+
+    async def _resolve_topic(self, message: Message, chat):
+        """
+        Определяет топик форума, в контексте которого вызвана команда.
+        Возвращает (topic_id, topic_title) или (None, None) для обычного чата.
+        """
+        if not (isinstance(chat, Channel) and chat.forum):
+            return None, None
+
+        current_message_topic_id = getattr(message, 'topic_id', None)
+        if current_message_topic_id:
+            return current_message_topic_id, None
+
+        if message.reply_to_msg_id:
+            replied_msg = await message.get_reply_message()
+            if replied_msg:
+                replied_msg_topic_id = getattr(replied_msg, 'topic_id', None)
+                if replied_msg_topic_id:
+                    return replied_msg_topic_id, None
+                if isinstance(replied_msg.action, MessageActionTopicCreate):
+                    return replied_msg.id, replied_msg.action.title
+
+        return None, None
+
+    async def _get_topic_title(self, chat, topic_id: int) -> str:
+        try:
+            topic_creation_message = await self.client.get_messages(chat, ids=topic_id)
+            if topic_creation_message and isinstance(topic_creation_message.action, MessageActionTopicCreate):
+                return topic_creation_message.action.title
+        except Exception as e:
+            self.logger.warning(f"Не удалось получить название топика {topic_id} в чате {chat.id}: {e}")
+        return f"ID: {topic_id}"
+
+    async def _get_participants_count(self, chat, chat_id: int):
+        if isinstance(chat, (Channel, Chat)):
+            if chat.participants_count is not None:
+                return chat.participants_count
+            count = self._participants.get(chat_id, self.config["participants_cache_ttl"])
+            if count is not None:
+                return count
+            try:
+                participants_obj = await self.client.get_participants(chat, limit=0)
+                self._participants.put(chat_id, participants_obj.total, self.config["participants_cache_size"])
+                return participants_obj.total
+            except Exception as e:
+                self.logger.error(f"Ошибка при получении количества участников для чата {chat.id}: {e}")
+        elif isinstance(chat, User):
+            return 2
+        return self.strings("unavailable")
+
+    async def _count_fast(self, chat, topic_id: int = None) -> dict:
+        """
+        Счётчики по типам медиа одним запросом messages.getSearchCounters,
+        общее число сообщений — из поля count ответа истории (limit=0).
+        Значения считает Telegram по своим фильтрам, поэтому они могут немного
+        отличаться от точного подсчёта перебором.
+        """
+        history = await self.client.get_messages(chat, limit=0, reply_to=topic_id)
+        counters = await self.client(GetSearchCountersRequest(
+            peer=chat,
+            filters=[search_filter() for search_filter in SEARCH_FILTERS.values()],
+            top_msg_id=topic_id,
+        ))
+
+        by_filter = {type(counter.filter): counter.count for counter in counters}
+        counts = {field: by_filter.get(search_filter, 0) for field, search_filter in SEARCH_FILTERS.items()}
+        counts["total"] = history.total
+        return counts
+
+    async def _list_topics(self, chat) -> list:
+        """Все топики форума постранично: список (topic_id, title)."""
+        topics = []
+        offset_date, offset_id, offset_topic = None, 0, 0
+        while True:
+            result = await self.client(GetForumTopicsRequest(
+                channel=chat,
+                offset_date=offset_date,
+                offset_id=offset_id,
+                offset_topic=offset_topic,
+                limit=100,
+            ))
+            page = [topic for topic in result.topics if isinstance(topic, ForumTopic)]
+            topics.extend((topic.id, topic.title) for topic in page)
+            if len(result.topics) < 100 or len(topics) >= result.count or not page:
+                return topics
+
+            last = page[-1]
+            last_message = next((msg for msg in result.messages if msg.id == last.top_message), None)
+            offset_date = last_message.date if last_message else None
+            offset_id = last.top_message
+            offset_topic = last.id
+
+    async def _count_topics(self, chat) -> list:
+        """
+        Счётчики для всех топиков форума: по одному запросу search counters и одному
+        запросу истории на топик, параллельно с общей паузой по FloodWait.
+        Возвращает список (title, counts), отсортированный по числу сообщений;
+        топик, который не удалось посчитать, остаётся в списке с полями «Недоступно».
+        """
+        topics = await self._list_topics(chat)
+        semaphore = asyncio.Semaphore(self.config["scan_concurrency"])
+        gate = _FloodGate()
+
+        async def count(topic_id: int, title: str):
+            async with semaphore:
+                while True:
+                    await gate.wait()
+                    try:
+                        return title, await self._count_fast(chat, topic_id)
+                    except FloodWaitError as e:
+                        await gate.pause(e.seconds)
+                    except Exception as e:
+                        self.logger.warning(f"Не удалось посчитать топик {topic_id} в чате {chat.id}: {e}")
+                        return title, dict.fromkeys(COUNT_FIELDS, self.strings("unavailable"))
+
+        results = await asyncio.gather(*(count(topic_id, title) for topic_id, title in topics))
+        # Недоступные топики — в конец списка
+        return sorted(results, key=lambda item: item[1]["total"] if isinstance(item[1]["total"], int) else -1, reverse=True)
+
+    # Символы для тепловой карты и графиков, от пустого к максимальному
+    SPARK_CHARS = " ▁▂▃▄▅▆▇█"
+    WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+    def _spark(self, values) -> str:
+        peak = values.max() if len(values) else 0
+        if not peak:
+            return self.SPARK_CHARS[0] * len(values)
+        levels = np.ceil(values / peak * (len(self.SPARK_CHARS) - 1)).astype(int)
+        return "".join(self.SPARK_CHARS[level] for level in levels)
+
+    def _format_activity(self, columns: _ActivityColumns) -> str:
+        """Векторные агрегаты по колонкам: тепловая карта, дневной ряд и доля медиа по месяцам."""
+        dates, senders, media = columns.columns()
+        if not len(dates):
+            return self.strings("activity_empty")
+
+        dates = dates.astype(np.int64)
+        days = dates // 86400
+        hours = (dates // 3600) % 24
+        # 1 января 1970 года — четверг, сдвигаем так, чтобы 0 был понедельником
+        weekdays = (days + 3) % 7
+        heatmap = np.bincount(weekdays * 24 + hours, minlength=7 * 24).reshape(7, 24)
+        heat_rows = "\n".join(f"{self.WEEKDAYS[day]} {self._spark(heatmap[day])}" for day in range(7))
+
+        daily = np.bincount(days - days.min())
+        last_days = daily[-30:]
+        busiest = int(daily.argmax())
+        busiest_date = time.strftime("%d.%m.%Y", time.gmtime((days.min() + busiest) * 86400))
+
+        months = dates.astype("datetime64[s]").astype("datetime64[M]").astype(np.int64)
+        month_offset = months - months.min()
+        per_month = np.bincount(month_offset, minlength=month_offset.max() + 1)
+        media_per_month = np.bincount(month_offset, weights=(media > 0), minlength=month_offset.max() + 1)
+        share_rows = []
+        for offset in range(max(len(per_month) - 12, 0), len(per_month)):
+            if not per_month[offset]:
+                continue
+            year, month = divmod(int(months.min() + offset), 12)
+            share_rows.append(f"{1970 + year}-{month + 1:02d}: {media_per_month[offset] / per_month[offset]:.0%}")
+
+        return self.strings("activity_stats").format(
+            len(dates),
+            int(np.unique(senders[senders != 0]).size),
+            heat_rows,
+            self._spark(last_days),
+            f"{daily.mean():.1f}",
+            busiest_date,
+            int(daily[busiest]),
+            "\n".join(share_rows),
+        )
+
+    async def _activity_command(self, message: Message, chat):
+        await message.edit(self.strings("collecting_activity"))
+        target_topic_id, _ = await self._resolve_topic(message, chat)
+        columns = _ActivityColumns()
+        partial = False
+        try:
+            await self._scan_exact(chat, target_topic_id, columns.add_message)
+        except _ScanInterrupted as e:
+            self.logger.error(f"Сбор активности для чата {chat.id} прерван: {e.__cause__}")
+            partial = True
+        except Exception as e:
+            self.logger.error(f"Ошибка при сборе активности для чата {chat.id}: {e}")
+            await message.edit(self.strings("activity_empty"))
+            return
+        if partial and not columns.size:
+            await message.edit(self.strings("activity_empty"))
+            return
+        text = self._format_activity(columns)
+        if partial:
+            text += self.strings("partial_stats")
+        await message.edit(text)
+
+    async def _topics_command(self, message: Message, chat):
+        if not (isinstance(chat, Channel) and chat.forum):
+            await message.edit(self.strings("not_forum"))
+            return
+
+        await message.edit(self.strings("collecting_topics_stats"))
+        try:
+            if self._sqlite_has(message.chat_id):
+                results = self._sqlite.topic_counts(message.chat_id)
+            else:
+                results = await self._count_topics(chat)
+        except Exception as e:
+            self.logger.error(f"Ошибка при подсчёте статистики топиков в чате {chat.id}: {e}")
+            await message.edit(self.strings("topics_stats_header").format(self.strings("unavailable")))
+            return
+
+        lines = [self.strings("topics_stats_header").format(len(results))]
+        length = len(lines[0])
+        for shown, (title, counts) in enumerate(results):
+            row = self.strings("topics_stats_row").format(utils.escape_html(title), *(counts[field] for field in COUNT_FIELDS))
+            # Укладываемся в лимит длины сообщения Telegram
+            if length + len(row) > 3900:
+                lines.append(self.strings("topics_stats_more").format(len(results) - shown))
+                break
+            lines.append(row)
+            length += len(row) + 1
+
+        await message.edit("\n".join(lines))
+
+    async def _index_command(self, message: Message, chat, args: list):
+        if args and args[0].lower() == "off":
+            self._index.pop(message.chat_id, None)
+            self._staged.pop(message.chat_id, None)
+            self._save_index()
+            await message.edit(self.strings("index_disabled"))
+            return
+
+        await message.edit(self.strings("index_building"))
+        try:
+            record = await self._build_index(chat)
+            self._index[message.chat_id] = record
+            # Догоняем сообщения, пришедшие во время построения
+            await self._count_indexed(chat, message.chat_id, record)
+        except Exception as e:
+            self.logger.error(f"Ошибка при построении индекса для чата {chat.id}: {e}")
+            self._index.pop(message.chat_id, None)
+            self._staged.pop(message.chat_id, None)
+            await message.edit(self.strings("index_failed"))
+            return
+        await message.edit(self.strings("index_enabled"))
+
+    # Повторы страницы истории при ошибках, отличных от FloodWait
+    PAGE_RETRIES = 3
+    PAGE_RETRY_DELAY = 2
+
+    async def _iter_history(self, chat, topic_id, low: int, high: int, pacer: _AdaptivePacer):
+        """
+        Сообщения с id в (low, high] от новых к старым, страницами под управлением pacer.
+        После FloodWait или сбоя запрос повторяется с последнего offset_id, поэтому
+        ни одно сообщение не выдаётся дважды.
+        """
+        offset = high + 1
+        failures = 0
+        while True:
+            try:
+                result = await pacer.fetch(
+                    lambda limit: self.client.get_messages(chat, limit=limit, offset_id=offset, min_id=low, reply_to=topic_id)
+                )
+            except Exception:
+                failures += 1
+                pacer.failed()
+                if failures > self.PAGE_RETRIES:
+                    raise
+                await asyncio.sleep(self.PAGE_RETRY_DELAY * 2 ** (failures - 1))
+                continue
+            if result is None:
+                continue
+
+            failures = 0
+            page, limit = result
+            for msg in page:
+                yield msg
+            if len(page) < limit:
+                return
+            offset = page[-1].id
+
+    async def _scan_shard(self, chat, topic_id, low: int, high: int, pacer: _AdaptivePacer, counts: dict, on_message=None):
+        """
+        Добавляет в counts сообщения с id в (low, high].
+        `on_message`, если задан, вызывается для каждого сообщения ровно один раз.
+        """
+        async for msg in self._iter_history(chat, topic_id, low, high, pacer):
+            counts["total"] += 1
+            field = classify_media(msg)
+            if field:
+                counts[field] += 1
+            if on_message is not None:
+                on_message(msg)
+
+    async def _scan_exact(self, chat, topic_id: int = None, on_message=None, min_id: int = 0):
+        """
+        Точный подсчёт: пространство id (min_id, top_id] делится на диапазоны, которые
+        сканируются параллельно с общим ограничением и общим темпом запросов.
+        Возвращает (счётчики, top_id). Если один из диапазонов не удалось дочитать,
+        остальные отменяются и выбрасывается _ScanInterrupted с частичными счётчиками.
+        """
+        top = await self.client.get_messages(chat, limit=1, reply_to=topic_id)
+        top_id = top[0].id if top else 0
+        counts = dict.fromkeys(COUNT_FIELDS, 0)
+        if top_id <= min_id:
+            return counts, top_id
+
+        span = top_id - min_id
+        shards = min(self.config["scan_shards"], span)
+        semaphore = asyncio.Semaphore(self.config["scan_concurrency"])
+        pacer = _AdaptivePacer()
+
+        async def run(index: int):
+            async with semaphore:
+                low = min_id + span * index // shards
+                high = min_id + span * (index + 1) // shards
+                await self._scan_shard(chat, topic_id, low, high, pacer, counts, on_message)
+
+        tasks = [asyncio.ensure_future(run(i)) for i in range(shards)]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise _ScanInterrupted(counts) from e
+
+        return counts, top_id
+
+    # Сообщений в одном окне выборки (максимум одного запроса истории)
+    SAMPLE_WINDOW = 100
+    # Минимум окон до первой проверки погрешности
+    SAMPLE_MIN_WINDOWS = 5
+
+    async def _count_approx(self, chat, topic_id: int = None) -> dict:
+        """
+        Приблизительный подсчёт: случайные окна по 100 сообщений, доли типов медиа
+        оцениваются отношением сумм по окнам, а 95% погрешность — по разбросу между окнами.
+        Выборка останавливается, когда погрешность всех полей не больше approx_error
+        от общего числа сообщений или исчерпан approx_budget запросов.
+        Возвращает поля вида "≈N ± M"; общее число сообщений точное.
+        """
+        history = await self.client.get_messages(chat, limit=0, reply_to=topic_id)
+        total = history.total
+        top = await self.client.get_messages(chat, limit=1, reply_to=topic_id)
+        top_id = top[0].id if top else 0
+        fields = [field for field in COUNT_FIELDS if field != "total"]
+        if not total or not top_id:
+            return dict.fromkeys(COUNT_FIELDS, 0)
+
+        windows = []  # (сообщений в окне, {поле: количество})
+        target = self.config["approx_error"]
+        margins = {}
+        for _ in range(self.config["approx_budget"]):
+            offset_id = random.randint(1, top_id + 1)
+            try:
+                sample = await self.client.get_messages(chat, limit=self.SAMPLE_WINDOW, offset_id=offset_id, reply_to=topic_id)
+            except FloodWaitError as e:
+                await asyncio.sleep(e.seconds)
+                continue
+            if not sample:
+                continue
+
+            window_counts = dict.fromkeys(fields, 0)
+            for msg in sample:
+                field = classify_media(msg)
+                if field:
+                    window_counts[field] += 1
+            windows.append((len(sample), window_counts))
+
+            if len(windows) >= self.SAMPLE_MIN_WINDOWS:
+                margins = self._approx_margins(windows, fields)
+                if max(margins.values()) <= target:
+                    break
+
+        if len(windows) < 2:
+            return dict.fromkeys(COUNT_FIELDS, self.strings("unavailable"))
+
+        margins = self._approx_margins(windows, fields)
+        sampled = sum(size for size, _ in windows)
+        counts = {"total": total}
+        for field in fields:
+            share = sum(window[field] for _, window in windows) / sampled
+            counts[field] = f"≈{round(share * total)} ± {math.ceil(margins[field] * total)}"
+        return counts
+
+    @staticmethod
+    def _approx_margins(windows: list, fields: list) -> dict:
+        """
+        95% погрешность доли каждого поля для кластерной выборки (оценка отношением).
+        Для редких полей разброс между окнами почти нулевой (при нуле попаданий — ровно ноль),
+        поэтому снизу погрешность ограничена расстоянием до верхней границы интервала Уилсона.
+        """
+        z = 1.96
+        k = len(windows)
+        sampled = sum(size for size, _ in windows)
+        mean_size = sampled / k
+        margins = {}
+        for field in fields:
+            share = sum(window[field] for _, window in windows) / sampled
+            residuals = sum((window[field] - share * size) ** 2 for size, window in windows)
+            variance = residuals / (k * (k - 1) * mean_size ** 2)
+            # Верхняя граница интервала Уилсона; при нуле попаданий ≈ 3.84 / sampled
+            spread = z * math.sqrt(share * (1 - share) / sampled + z ** 2 / (4 * sampled ** 2))
+            wilson_upper = (share + z ** 2 / (2 * sampled) + spread) / (1 + z ** 2 / sampled)
+            margins[field] = max(z * math.sqrt(variance), wilson_upper - share)
+        return margins
+
+    async def _count_exact(self, chat, topic_id: int = None, senders: _SenderStats = None) -> dict:
+        """Точный подсчёт перебором всех сообщений чата или топика."""
+        counts, _ = await self._scan_exact(chat, topic_id, senders.add_message if senders else None)
+        return counts
+
+    async def _format_senders(self, senders: _SenderStats) -> str:
+        lines = [self.strings("senders_header").format(senders.unique.estimate())]
+        for place, (sender_id, count, error) in enumerate(senders.heavy_hitters.top(senders.top_k), 1):
+            try:
+                entity = await self.client.get_entity(sender_id)
+                name = getattr(entity, "first_name", None) or getattr(entity, "title", None) or str(sender_id)
+            except Exception:
+                name = str(sender_id)
+            # Погрешность Space-Saving: реальное число сообщений в [count - error, count]
+            count_text = f"{count}" if not error else f"{count - error}–{count}"
+            lines.append(self.strings("senders_row").format(place, sender_id, utils.escape_html(name), count_text))
+        return "\n".join(lines)
 
     @loader.command()
     async def chatstats(self, message: Message):
@@ -60,137 +1235,75 @@ class ChatStatsMod(loader.Module):
             await message.edit(self.strings("no_chat"))
             return
 
+        args = utils.get_args(message)
+        mode = args[0].lower() if args else None
+        exact = mode == "exact"
+        approx = mode == "~"
+
         chat = await message.get_chat()
-        
-        is_topic_context = False
-        target_topic_id = None
-        topic_title = None
-
-        if isinstance(chat, Channel) and chat.forum:
-            current_message_topic_id = getattr(message, 'topic_id', None)
-            if current_message_topic_id:
-                target_topic_id = current_message_topic_id
-                is_topic_context = True
-            elif message.reply_to_msg_id:
-                replied_msg = await message.get_reply_message()
-                if replied_msg:
-                    replied_msg_topic_id = getattr(replied_msg, 'topic_id', None)
-                    if replied_msg_topic_id:
-                        target_topic_id = replied_msg_topic_id
-                        is_topic_context = True
-                    elif isinstance(replied_msg.action, MessageActionTopicCreate):
-                        target_topic_id = replied_msg.id
-                        is_topic_context = True
-                        topic_title = replied_msg.action.title
-        
-        if is_topic_context:
-            await message.edit(self.strings("collecting_topic_stats"))
-            
-            if topic_title is None and target_topic_id:
-                try:
-                    topic_creation_message = await self.client.get_messages(chat, ids=target_topic_id)
-                    if topic_creation_message and isinstance(topic_creation_message.action, MessageActionTopicCreate):
-                        topic_title = topic_creation_message.action.title
-                except Exception as e:
-                    self.logger.warning(f"Не удалось получить название топика {target_topic_id} в чате {chat.id}: {e}")
-            
-            if topic_title is None:
-                topic_title = f"ID: {target_topic_id}"
 
-            video_count = 0
-            file_count = 0
-            voice_count = 0
-            video_note_count = 0
-            photo_count = 0
-            messages_iterated_count = 0
+        if mode == "index":
+            await self._index_command(message, chat, args[1:])
+            return
 
-            try:
-                async for msg in self.client.iter_messages(chat, reply_to=target_topic_id, limit=None):
-                    messages_iterated_count += 1
-                    if msg.media:
-                        if msg.video_note:
-                            video_note_count += 1
-                        elif msg.voice:
-                            voice_count += 1
-                        elif msg.video:
-                            video_count += 1
-                        elif msg.photo:
-                            photo_count += 1
-                        elif msg.document:
-                            if not msg.gif and not msg.sticker:
-                                file_count += 1
-            except Exception as e:
-                self.logger.error(f"Ошибка во время итерации сообщений для топика {target_topic_id} в чате {chat.id}: {e}")
-                messages_iterated_count = "Недоступно"
-                video_count = "Недоступно"
-                file_count = "Недоступно"
-                voice_count = "Недоступно"
-                video_note_count = "Недоступно"
-                photo_count = "Недоступно"
-            
-            await message.edit(self.strings("topic_stats").format(
-                topic_title,
-                messages_iterated_count,
-                photo_count,
-                video_count,
-                file_count,
-                voice_count,
-                video_note_count
-            ))
+        if mode == "topics":
+            await self._topics_command(message, chat)
+            return
+
+        if mode == "activity":
+            await self._activity_command(message, chat)
+            return
+
+        if mode == "crawl":
+            await self._crawl_command(message, chat)
+            return
+
+        target_topic_id, topic_title = await self._resolve_topic(message, chat)
+        is_topic_context = target_topic_id is not None
 
+        if is_topic_context:
+            await message.edit(self.strings("collecting_topic_stats"))
+            if topic_title is None:
+                topic_title = await self._get_topic_title(chat, target_topic_id)
         else:
             await message.edit(self.strings("collecting_chat_stats"))
+            participants_count = await self._get_participants_count(chat, message.chat_id)
 
-            participants_count = "Недоступно"
-            if isinstance(chat, (Channel, Chat)):
-                if chat.participants_count is not None:
-                    participants_count = chat.participants_count
-                else:
-                    try:
-                        participants_obj = await self.client.get_participants(chat, limit=0)
-                        participants_count = participants_obj.total
-                    except Exception as e:
-                        self.logger.error(f"Ошибка при получении количества участников для чата {chat.id}: {e}")
-            elif isinstance(chat, User):
-                participants_count = 2
+        senders = None
+        partial = False
+        try:
+            if exact:
+                senders = _SenderStats(self.config["top_senders"]) if self.config["top_senders"] else None
+                counts = await self._count_exact(chat, target_topic_id, senders)
+            elif approx:
+                counts = await self._count_approx(chat, target_topic_id)
+            elif self._sqlite_has(message.chat_id):
+                # Без запросов к Telegram: данные на момент последнего .chatstats crawl
+                counts = self._sqlite.counts(message.chat_id, target_topic_id)
+            elif not is_topic_context and message.chat_id in self._index:
+                counts = await self._count_indexed(chat, message.chat_id, self._index[message.chat_id])
+            else:
+                counts = await self._count_fast(chat, target_topic_id)
+        except _ScanInterrupted as e:
+            # Точный перебор прерван: показываем то, что успели посчитать
+            self.logger.error(f"Точный подсчёт в чате {chat.id} прерван: {e.__cause__}")
+            counts = e.counts
+            partial = True
+        except Exception as e:
+            if is_topic_context:
+                self.logger.error(f"Ошибка во время подсчёта сообщений для топика {target_topic_id} в чате {chat.id}: {e}")
+            else:
+                self.logger.error(f"Ошибка во время подсчёта сообщений для чата {chat.id}: {e}")
+            counts = dict.fromkeys(COUNT_FIELDS, self.strings("unavailable"))
+            senders = None
 
-            video_count = 0
-            file_count = 0
-            voice_count = 0
-            video_note_count = 0
-            photo_count = 0
-            messages_iterated_count = 0
-
-            try:
-                async for msg in self.client.iter_messages(chat, limit=None):
-                    messages_iterated_count += 1
-                    if msg.media:
-                        if msg.video_note:
-                            video_note_count += 1
-                        elif msg.voice:
-                            voice_count += 1
-                        elif msg.video:
-                            video_count += 1
-                        elif msg.photo:
-                            photo_count += 1
-                        elif msg.document:
-                            if not msg.gif and not msg.sticker:
-                                file_count += 1
-            except Exception as e:
-                self.logger.error(f"Ошибка во время итерации сообщений для чата {chat.id}: {e}")
-                messages_iterated_count = "Недоступно"
-                video_count = "Недоступно"
-                file_count = "Недоступно"
-                voice_count = "Недоступно"
-                video_note_count = "Недоступно"
-                photo_count = "Недоступно"
-            
-            await message.edit(self.strings("chat_stats").format(
-                participants_count,
-                messages_iterated_count,
-                photo_count,
-                video_count,
-                file_count,
-                voice_count,
-                video_note_count
-            ))
+        values = [counts[field] for field in COUNT_FIELDS]
+        if is_topic_context:
+            text = self.strings("topic_stats").format(topic_title, *values)
+        else:
+            text = self.strings("chat_stats").format(participants_count, *values)
+        if senders is not None:
+            text += await self._format_senders(senders)
+        if partial:
+            text += self.strings("partial_stats")
+        await message.edit(text)